@@ -0,0 +1,58 @@
+"""Benchmark download_images against a local stand-in for images.proteinatlas.org."""
+import os
+import sys
+import time
+import tempfile
+
+import requests
+from fixtures import IMAGE_SIZE, serve
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "xml_utils"))
+
+from image_downloader import download_images  # noqa: E402
+
+
+def download_images_serial(image_urls, folder):
+    # The download loop as it was before download_images went concurrent
+    image_files = []
+    for i, url in enumerate(image_urls, start=1):
+        response = requests.get(url, stream=True)
+        response.raise_for_status()
+        image_file_path = os.path.join(folder, url.split("/")[-1] or f"image_{i}.jpg")
+        with open(image_file_path, "wb") as file:
+            for chunk in response.iter_content(chunk_size=8192):
+                if chunk:
+                    file.write(chunk)
+                    file.flush()
+                    os.fsync(file.fileno())
+        image_files.append(image_file_path)
+    return image_files
+
+
+def timed(function, *args, **kwargs):
+    start = time.perf_counter()
+    function(*args, **kwargs)
+    return time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    n_images = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    server = serve()
+    urls = [f"{server.url}/{i // 50}/{i}_A_1_1.jpg" for i in range(n_images)]
+
+    with tempfile.TemporaryDirectory() as serial_dir, tempfile.TemporaryDirectory() as concurrent_dir:
+        manifest = os.path.join(concurrent_dir, "manifest.sqlite")
+        other_manifest = os.path.join(concurrent_dir, "other.sqlite")
+        serial = timed(download_images_serial, urls, serial_dir)
+        concurrent = timed(download_images, urls, folder=concurrent_dir, manifest=manifest)
+        # without the manifest every file present on disk is checked with a HEAD request
+        warm = timed(download_images, urls, folder=concurrent_dir, manifest=other_manifest)
+        recorded = timed(download_images, urls, folder=concurrent_dir, manifest=manifest)
+
+    server.shutdown()
+    megabytes = n_images * IMAGE_SIZE / 2**20
+    print(f"{n_images} images, {megabytes:.0f} MB")
+    print(f"serial:               {serial:7.2f}s  {megabytes / serial:7.1f} MB/s")
+    print(f"concurrent:           {concurrent:7.2f}s  {megabytes / concurrent:7.1f} MB/s")
+    print(f"concurrent, re-run:   {warm:7.2f}s  (files already present)")
+    print(f"concurrent, recorded: {recorded:7.2f}s  (urls in the image manifest)")
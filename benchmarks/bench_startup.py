@@ -0,0 +1,90 @@
+"""
+Dashboard startup: import time of its modules and time to the first rendered page, each in a fresh interpreter.
+
+    python benchmarks/bench_startup.py [--repeat 5] [--genes 20000]
+
+The first render runs app.py with streamlit's AppTest against the local API stand-in,
+with a fresh lookup snapshot in the cache so nothing is fetched from proteinatlas.org.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+from tempfile import TemporaryDirectory
+
+import synthetic
+import pandas as pd
+from fixtures import serve
+
+DASHBOARD = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "dashboard")
+
+# What app.py imports, in a fresh interpreter
+IMPORT_SCRIPT = "import local_backend, utils, sidebar, data_processing, image_grid, download_handlers, metrics"
+
+# Prints the seconds until AppTest's first run is over and the app's own first_render measure
+RENDER_SCRIPT = """
+import sys, time, json
+started = time.perf_counter()
+from streamlit.testing.v1 import AppTest
+app = AppTest.from_file(sys.argv[1], default_timeout=60).run()
+elapsed = time.perf_counter() - started
+assert not app.exception, app.exception
+print(json.dumps({"seconds": elapsed, "first_render": app.session_state["first_render"]}))
+"""
+
+
+def write_lookup_snapshot(cache_dir, genes):
+    # Same files as utils.download_lookup_df, checked just now so they are used as they are
+    os.makedirs(cache_dir, exist_ok=True)
+    lookup_df = pd.DataFrame({"gene": [f"GENE{i}" for i in range(genes)], "ensembl": [f"ENSG{i:011d}" for i in range(genes)]})
+    lookup_df.to_parquet(os.path.join(cache_dir, "lookup.parquet"), index=False)
+    with open(os.path.join(cache_dir, "lookup.json"), "w") as file:
+        json.dump({"etag": None, "checked_at": time.time()}, file)
+
+
+def import_time():
+    start = time.perf_counter()
+    subprocess.run([sys.executable, "-c", IMPORT_SCRIPT], cwd=DASHBOARD, check=True)
+    return time.perf_counter() - start
+
+
+def first_render(workdir, api_url):
+    """
+    returns {"seconds": interpreter start to the first page, "first_render": what the app measured itself}
+    """
+    env = dict(os.environ, API_URL=f"{api_url}/", PYTHONPATH=DASHBOARD)
+    for variable in ["LOCAL_DATASET", "INTERACTION_GRAPH", "IMAGE_MANIFEST"]:
+        env.pop(variable, None)
+
+    start = time.perf_counter()
+    output = subprocess.run(
+        [sys.executable, "-c", RENDER_SCRIPT, os.path.join(DASHBOARD, "app.py")],
+        cwd=workdir,
+        env=env,
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout
+    result = json.loads(output.strip().splitlines()[-1])
+    result["seconds"] = time.perf_counter() - start
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--genes", type=int, default=20000, help="genes in the lookup snapshot")
+    args = parser.parse_args()
+
+    server = serve(entries=synthetic.api_entries(1000))
+    with TemporaryDirectory() as workdir:
+        write_lookup_snapshot(os.path.join(workdir, "cache"), args.genes)
+        imports = min(import_time() for _ in range(args.repeat))
+        renders = [first_render(workdir, server.url) for _ in range(args.repeat)]
+    server.shutdown()
+
+    print(f"dashboard imports:                   {imports * 1000:8.0f}ms")
+    print(f"first page, interpreter start:       {min(render['seconds'] for render in renders) * 1000:8.0f}ms")
+    print(f"first page, measured by app.py:      {min(render['first_render'] for render in renders) * 1000:8.0f}ms")
@@ -0,0 +1,89 @@
+"""Benchmark get_patient_info against a frozen copy of its ElementPath version, on a synthetic large gene."""
+import io
+import os
+import sys
+import time
+
+import synthetic
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "xml_utils"))
+
+from xml_parser import load_xml, get_patient_info, process_xml_stream  # noqa: E402
+
+
+# Frozen copy of the extraction before the single-pass version: one path search per field and per level
+def get_patient_images_baseline(patient, names):
+    patient_id = int(patient.find("patientId").text)
+    sex = patient.find("sex").text
+    age = int(patient.find("age").text)
+
+    staining_element = patient.find("level[@type='staining']")
+    staining = staining_element.text if staining_element is not None else None
+
+    intensity = patient.find("level[@type='intensity']")
+    intensity = intensity.text if intensity is not None else None
+
+    quantity = patient.find("quantity")
+    quantity = quantity.text if quantity is not None else None
+
+    location = patient.find("location")
+    location = location.text if location is not None else None
+
+    patient_images_info = []
+    for sample in patient.findall(".//sample"):
+        snomed_parameters = sample.find("snomedParameters")
+        tissue_descriptions = [snomed.attrib["tissueDescription"] for snomed in snomed_parameters.findall("snomed")]
+
+        assay_image = sample.find("assayImage")
+        for image in assay_image.findall("image"):
+            patient_images_info.append(
+                {
+                    "gene_names": names,
+                    "patientId": str(patient_id),
+                    "sex": sex,
+                    "age": age,
+                    "staining": staining,
+                    "intensity": intensity,
+                    "quantity": quantity,
+                    "location": location,
+                    "tissueDescriptions": tissue_descriptions,
+                    "imageUrl": image.find("imageUrl").text,
+                }
+            )
+    return patient_images_info
+
+
+def get_patient_info_baseline(root, names):
+    patient_images_info = []
+    for tissue_cell in root.findall(".//tissueExpression"):
+        if tissue_cell.find("summary").attrib["type"] != "pathology":
+            continue
+        for patient in tissue_cell.findall(".//patient"):
+            patient_images_info.extend(get_patient_images_baseline(patient, names))
+    return patient_images_info
+
+
+def best_of(repeat, function, *args):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function(*args)
+        times.append(time.perf_counter() - start)
+    return min(times), result
+
+
+if __name__ == "__main__":
+    patients = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    content = synthetic.gene_xml("BENCH1", patients=patients, samples=3, images=3)
+    root = load_xml(io.BytesIO(content))
+    names = ["BENCH1", "BENCH1-S1", "BENCH1-S2"]
+
+    baseline, expected = best_of(9, get_patient_info_baseline, root, names)
+    single_pass, records = best_of(9, get_patient_info, root, names)
+    stream, streamed = best_of(3, lambda: process_xml_stream(io.BytesIO(content)))
+    assert records == expected and streamed == expected, "output differs from the baseline"
+
+    print(f"{patients} patients, {len(records)} images, {len(content) / 2**20:.0f} MB of XML")
+    print(f"get_patient_info, ElementPath (baseline): {baseline * 1000:8.1f}ms")
+    print(f"get_patient_info, single pass:            {single_pass * 1000:8.1f}ms  ({baseline / single_pass:.1f}x)")
+    print(f"process_xml_stream (parse included):      {stream * 1000:8.1f}ms")
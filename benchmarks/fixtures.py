@@ -0,0 +1,90 @@
+"""Local stand-ins for proteinatlas.org (XML and interaction pages), images.proteinatlas.org and the API."""
+import json
+import time
+import random
+import threading
+from urllib.parse import parse_qs, urlsplit
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+IMAGE_SIZE = 300 * 1024
+LATENCY = 0.02  # seconds per request, roughly a nearby CDN
+
+
+class FixtureHandler(BaseHTTPRequestHandler):
+    """
+    GET /<ensembl id>.xml               the gene XML
+    GET /<ensembl id>-<gene>/interaction the interaction page
+    GET /api/samples?page=&perPage=     a page of API entries
+    GET|HEAD *.jpg                      an image, with Range support
+    """
+
+    body = random.Random(0).randbytes(IMAGE_SIZE)
+
+    def _reply(self, status, content_type, content, head=False, headers=()):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(content)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        if not head:
+            self.wfile.write(content)
+
+    def _image(self, head):
+        start = 0
+        if "Range" in self.headers:
+            start = int(self.headers["Range"].split("=")[1].split("-")[0])
+            range_header = [("Content-Range", f"bytes {start}-{IMAGE_SIZE - 1}/{IMAGE_SIZE}")]
+            return self._reply(206, "image/jpeg", self.body[start:], head, range_header)
+        return self._reply(200, "image/jpeg", self.body, head)
+
+    def _samples(self, query):
+        page, per_page = int(query.get("page", ["1"])[0]), int(query.get("perPage", ["150"])[0])
+        entries = self.server.entries
+        data = entries[(page - 1) * per_page : page * per_page]
+        return self._reply(200, "application/json", json.dumps({"totalItems": len(entries), "data": data}).encode())
+
+    def _route(self, head):
+        time.sleep(self.server.latency)
+        url = urlsplit(self.path)
+
+        if url.path.endswith(".jpg"):
+            return self._image(head)
+        if url.path == "/api/samples":
+            return self._samples(parse_qs(url.query))
+        if url.path.endswith(".xml") and url.path[1:-4] in self.server.xml:
+            return self._reply(200, "application/xml", self.server.xml[url.path[1:-4]], head)
+        if url.path.endswith("/interaction"):
+            gene = url.path.split("/")[1].split("-", 1)[-1]
+            if gene in self.server.pages:
+                return self._reply(200, "text/html", self.server.pages[gene].encode(), head)
+        return self._reply(404, "text/plain", b"not found", head)
+
+    def do_GET(self):
+        self._route(head=False)
+
+    def do_HEAD(self):
+        self._route(head=True)
+
+    def log_message(self, *args):
+        pass
+
+
+def serve(xml=None, pages=None, entries=None, latency=LATENCY):
+    """
+    Start the stand-in server in a background thread.
+
+    Args:
+        xml (dict): ensembl id -> gene XML bytes.
+        pages (dict): gene -> interaction page html.
+        entries (list): API entries, see `synthetic.api_entries`.
+        latency (float): Seconds added to every request.
+
+    Returns:
+        ThreadingHTTPServer: The running server, its base url is `server.url`.
+    """
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FixtureHandler)
+    server.xml, server.pages, server.entries, server.latency = xml or {}, pages or {}, entries or [], latency
+    server.url = f"http://127.0.0.1:{server.server_address[1]}"
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
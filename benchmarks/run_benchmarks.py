@@ -0,0 +1,212 @@
+"""
+Time and memory of every pipeline stage against local fixtures, compared with the previous run.
+
+    python benchmarks/run_benchmarks.py [--patients 2000] [--samples 3] [--images 3] [--repeat 5]
+
+Each stage is run once under tracemalloc for its peak memory, then `--repeat` times for timing.
+Results are written to benchmarks/results/<timestamp>.json and compared with `--baseline`
+(by default the most recent earlier result), stages slower or bigger by more than `--threshold` are flagged.
+"""
+import os
+import sys
+import glob
+import json
+import time
+import argparse
+import platform
+import statistics
+import subprocess
+import tracemalloc
+from tempfile import TemporaryDirectory
+
+import synthetic
+import bench_startup
+from fixtures import serve
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+
+# xml_utils first: the dashboard's copies of shared modules are identical
+sys.path.insert(0, os.path.join(ROOT, "xml_utils"))
+sys.path.append(os.path.join(ROOT, "dashboard"))
+
+import utils  # noqa: E402
+import data_processing  # noqa: E402
+from xml_loader import download_xml  # noqa: E402
+from image_downloader import download_images  # noqa: E402
+from xml_parser import load_xml, process_xml, process_xml_stream  # noqa: E402
+from interactions import get_interactions, get_interactions_from_html  # noqa: E402
+
+FILTERS = {
+    "patientId": "",
+    "sex": "Any",
+    "age": (0, 100),
+    "staining": [],
+    "intensity": [],
+    "quantity": [],
+    "location": "",
+    "selected_tissues": "",
+    "interaction_type": "Any",
+    "confidence": "Any",
+    "mi_score": (0.0, 1.0),
+    "num_interactions": (0, 500),
+}
+
+
+def measure(function, repeat):
+    """
+    returns {"min", "median"} seconds over `repeat` runs and the tracemalloc "peak_kb" of one run
+    """
+    tracemalloc.start()
+    function()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+
+    return {"min": min(times), "median": statistics.median(times), "peak_kb": peak / 1024}
+
+
+def stages(server, args, workdir):
+    """
+    yields (stage name, function to benchmark)
+    """
+    xml_file = os.path.join(workdir, "BENCH1.xml")
+    with open(xml_file, "wb") as file:
+        file.write(server.xml["ENSG00000000001"])
+
+    yield "xml.load_and_process", lambda: process_xml(load_xml(xml_file))
+    yield "xml.load_and_process_compact", lambda: process_xml(load_xml(xml_file), compact=True)
+    yield "xml.process_stream", lambda: process_xml_stream(xml_file)
+    yield "xml.download", lambda: download_xml(f"{server.url}/ENSG00000000001.xml", "BENCH1")
+
+    image_urls = [f"{server.url}/{i % 10}/{i}_bench.jpg" for i in range(args.download_images)]
+    image_dirs = iter(range(10**6))
+
+    def download_images_cold():
+        # a fresh folder and manifest every run, images already downloaded would be skipped
+        run = next(image_dirs)
+        folder = os.path.join(workdir, f"images_{run}")
+        return download_images(image_urls, folder=folder, manifest=os.path.join(workdir, f"images_{run}.sqlite"))
+
+    yield "images.download", download_images_cold
+
+    gene_urls = {gene: f"{server.url}/ENSG00000000001-{gene}/interaction" for gene in server.pages}
+    yield "interactions.single_page", lambda: get_interactions_from_html("BENCH1", gene_urls["BENCH1"])
+    yield "interactions.all_pages", lambda: get_interactions(gene_urls)
+
+    def process_data_cold():
+        utils._responses.clear()
+        data_processing._results.clear()
+        return data_processing._process_data(FILTERS, [], {}, 1)
+
+    yield "dashboard.process_data_cold", process_data_cold
+    yield "dashboard.process_data_cached", lambda: data_processing.process_data(FILTERS, [], {}, 1)
+
+    # Fresh interpreters, like a new streamlit process
+    bench_startup.write_lookup_snapshot(os.path.join(workdir, "cache"), 20000)
+    yield "dashboard.import", bench_startup.import_time
+    yield "dashboard.first_render", lambda: bench_startup.first_render(workdir, server.url)
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return None
+
+
+def latest_result():
+    results = sorted(glob.glob(os.path.join(RESULTS_DIR, "*.json")))
+    return results[-1] if results else None
+
+
+def compare(results, baseline, threshold):
+    """
+    prints every stage against the baseline, returns the names of the regressed stages
+    """
+    regressions = []
+    # the fastest run is the least noisy one, it's what gets compared
+    print(f"{'stage':34} {'min':>10} {'peak':>12} {'vs baseline':>24}")
+    for stage, result in results.items():
+        line = f"{stage:34} {result['min'] * 1000:8.1f}ms {result['peak_kb']:10.0f}KB"
+        before = baseline.get(stage)
+        if before:
+            time_change = result["min"] / before["min"] - 1
+            memory_change = result["peak_kb"] / max(before["peak_kb"], 1) - 1
+            line += f" {time_change:+10.0%} {memory_change:+12.0%}"
+            if time_change > threshold or memory_change > threshold:
+                regressions.append(stage)
+                line += "  REGRESSION"
+        print(line)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--patients", type=int, default=2000)
+    parser.add_argument("--samples", type=int, default=3)
+    parser.add_argument("--images", type=int, default=3, help="images per sample")
+    parser.add_argument("--download-images", type=int, default=100, help="images fetched by images.download")
+    parser.add_argument("--genes", type=int, default=20, help="interaction pages fetched by interactions.all_pages")
+    parser.add_argument("--entries", type=int, default=5000, help="entries served by the API stand-in")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--latency", type=float, default=0.02, help="seconds added to every request")
+    parser.add_argument("--baseline", help="result file to compare with, defaults to the latest one")
+    parser.add_argument("--threshold", type=float, default=0.1, help="relative slowdown or growth reported as a regression")
+    parser.add_argument("--no-save", action="store_true")
+    args = parser.parse_args()
+
+    genes = [f"BENCH{i + 1}" for i in range(args.genes)]
+    server = serve(
+        xml={"ENSG00000000001": synthetic.gene_xml("BENCH1", args.patients, args.samples, args.images)},
+        pages={gene: synthetic.interactions_html(gene, seed=i) for i, gene in enumerate(genes)},
+        entries=synthetic.api_entries(args.entries, genes=genes),
+        latency=args.latency,
+    )
+    os.environ["API_URL"] = f"{server.url}/"
+    os.environ.pop("LOCAL_DATASET", None)
+    os.environ.pop("INTERACTION_GRAPH", None)
+
+    results = {}
+    cwd = os.getcwd()
+    with TemporaryDirectory() as workdir:
+        # download_xml writes to ./xml_files
+        os.chdir(workdir)
+        try:
+            for stage, function in stages(server, args, workdir):
+                results[stage] = measure(function, args.repeat)
+        finally:
+            os.chdir(cwd)
+    server.shutdown()
+
+    baseline_file = args.baseline or latest_result()
+    baseline = {}
+    if baseline_file:
+        print(f"baseline: {baseline_file}")
+        with open(baseline_file) as file:
+            baseline = json.load(file)["results"]
+    regressions = compare(results, baseline, args.threshold)
+
+    if not args.no_save:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        output = os.path.join(RESULTS_DIR, f"{time.strftime('%Y%m%d-%H%M%S')}.json")
+        meta = {
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "arguments": vars(args),
+        }
+        with open(output, "w") as file:
+            json.dump({"meta": meta, "results": results}, file, indent=1)
+        print(f"saved: {output}")
+
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,110 @@
+"""Synthetic HPA-shaped data for the benchmarks: gene XMLs, interaction pages and API answers."""
+import random
+from xml.sax.saxutils import escape
+
+SEXES = ["Male", "Female"]
+STAININGS = ["High", "Medium", "Low", "Not detected"]
+INTENSITIES = ["Strong", "Moderate", "Weak", "Negative"]
+QUANTITIES = [">75%", "75%-25%", "<25%", "None"]
+LOCATIONS = ["Cytoplasmic/membranous", "Nuclear", "Cytoplasmic/membranous,nuclear", "Membranous"]
+TISSUES = [
+    ("Breast", "Duct carcinoma"),
+    ("Colon", "Adenocarcinoma"),
+    ("Lung", "Squamous cell carcinoma"),
+    ("Prostate", "Adenocarcinoma"),
+    ("Skin", "Malignant melanoma"),
+]
+INTERACTION_TYPES = ["Physical association", "Direct interaction"]
+CONFIDENCES = ["High", "Medium", "Low"]
+
+
+def gene_xml(gene="BENCH1", patients=100, samples=2, images=2, seed=0) -> bytes:
+    """
+    Build the XML of one gene the way proteinatlas.org lays it out: an <entry> with names,
+    a non-pathology tissueExpression that must be skipped, and a pathology tissueExpression
+    with `patients` × `samples` × `images` image urls.
+    """
+    rng = random.Random(seed)
+    parts = [
+        '<?xml version="1.0" encoding="UTF-8"?>\n<proteinAtlas schemaVersion="3.2">\n',
+        f'<entry version="23" url="https://www.proteinatlas.org/ENSG00000000000-{gene}">\n',
+        f"<name>{gene}</name><synonym>{gene}-S1</synonym><synonym>{gene}-S2</synonym>\n",
+        '<tissueExpression source="HPA" technology="IHC" assayType="tissue"><summary type="tissue">Normal tissue</summary>',
+        "<data><tissue>Liver</tissue><patient><patientId>1</patientId><sex>Male</sex><age>40</age></patient></data>",
+        "</tissueExpression>\n",
+        '<antibody id="HPA000001">\n<tissueExpression source="HPA" technology="IHC" assayType="pathology">',
+        '<summary type="pathology">Cancer tissue</summary>\n',
+    ]
+
+    for patient in range(patients):
+        tissue, description = rng.choice(TISSUES)
+        parts.append(f"<data><tissue>{tissue} cancer</tissue><patient>")
+        parts.append(f"<sex>{rng.choice(SEXES)}</sex><age>{rng.randint(20, 95)}</age><patientId>{1000 + patient}</patientId>")
+        if rng.random() < 0.9:
+            parts.append(f'<level type="staining">{rng.choice(STAININGS)}</level>')
+        parts.append(f'<level type="intensity">{rng.choice(INTENSITIES)}</level>')
+        parts.append(f"<quantity>{escape(rng.choice(QUANTITIES))}</quantity><location>{rng.choice(LOCATIONS)}</location>")
+
+        for sample in range(samples):
+            parts.append(
+                "<sample><snomedParameters>"
+                f'<snomed tissueDescription="{tissue}" snomedCode="T-04000"/>'
+                f'<snomed tissueDescription="{description}" snomedCode="M-85003"/>'
+                "</snomedParameters><assayImage>"
+            )
+            for image in range(images):
+                url = f"https://images.proteinatlas.org/{patient % 97}/{patient}_{sample}_{image}_{gene}.jpg"
+                parts.append(f"<image><imageUrl>{url}</imageUrl></image>")
+            parts.append("</assayImage></sample>")
+        parts.append("</patient></data>\n")
+
+    parts.append("</tissueExpression>\n</antibody>\n</entry>\n</proteinAtlas>\n")
+    return "".join(parts).encode()
+
+
+def interactions_html(gene="BENCH1", partners=50, filler=2000, seed=0) -> str:
+    """
+    An interaction page: the "sortable" table the parser looks for, surrounded by `filler` unrelated blocks
+    """
+    rng = random.Random(seed)
+    padding = "".join(f"<div class='block'><p>Paragraph {i} of {gene} <a href='#'>link</a></p></div>" for i in range(filler))
+    rows = "".join(
+        f"<tr><td>P{rng.randint(0, 9999)}</td><td>{rng.choice(INTERACTION_TYPES)}</td><td>{rng.choice(CONFIDENCES)}</td>"
+        f"<td>{rng.random():.2f}</td><td>{rng.randint(1, 500)}</td></tr>"
+        for _ in range(partners)
+    )
+    header = "".join(
+        f"<th>{column}</th>" for column in ["Interaction", "Interaction type", "Confidence", "MI score", "# Interactions"]
+    )
+    return (
+        f"<html><body>{padding}<table class='sortable'><thead><tr>{header}</tr></thead>"
+        f"<tbody>{rows}</tbody></table>{padding}</body></html>"
+    )
+
+
+def api_entries(entries=1000, samples=3, genes=("BENCH1", "BENCH2", "BENCH3"), seed=0) -> list:
+    """
+    Entries shaped like the "data" list of the API's samples endpoint
+    """
+    rng = random.Random(seed)
+    data = []
+    for i in range(entries):
+        tissue, description = rng.choice(TISSUES)
+        data.append(
+            {
+                "staining": rng.choice(STAININGS),
+                "intensity": rng.choice(INTENSITIES),
+                "quantity": rng.choice(QUANTITIES),
+                "location": rng.choice(LOCATIONS),
+                "patient": {"id": 1000 + i, "age": rng.randint(20, 95), "sex": rng.choice(SEXES).upper()},
+                "gene": {"name": rng.choice(genes)},
+                "samples": [
+                    {
+                        "img": f"https://images.proteinatlas.org/{i % 97}/{i}_{sample}.jpg",
+                        "tissueDescription": f"{tissue}, {description}",
+                    }
+                    for sample in range(samples)
+                ],
+            }
+        )
+    return data
@@ -1,11 +1,17 @@
+import os
+import time
+
 import pandas as pd
+import local_backend
 import streamlit as st
+from utils import get_lookup
 from dotenv import load_dotenv
 from constants import PAGE_CONFIG
 from sidebar import render_sidebar
-from utils import download_lookup_df
 from data_processing import process_data
+from image_grid import render_image_grid
 from download_handlers import handle_downloads
+from metrics import REGISTRY, span, observe, summary
 
 # Set page configuration
 st.set_page_config(**PAGE_CONFIG)
@@ -13,7 +19,19 @@ st.set_page_config(**PAGE_CONFIG)
 PAGE_SIZE = 100
 
 
-def main(lookup_df):
+def render_metrics():
+    """
+    Debug panel with the time spent in every instrumented stage since the app started, shown when DEBUG_METRICS is set.
+    """
+    with st.expander("Metrics"):
+        st.dataframe(pd.DataFrame(summary(), columns=["name", "count", "total", "mean"]))
+        st.json(REGISTRY.snapshot()["counters"])
+        st.download_button("Download metrics", REGISTRY.to_prometheus(), file_name="metrics.txt", mime="text/plain")
+
+
+def main():
+    started = time.perf_counter()
+
     # Initialize session state to store the filtered dataframe and gene selections
     if (
         "filtered_df" not in st.session_state
@@ -27,32 +45,65 @@ def main(lookup_df):
     # FIXME: streamlit refreshes this every two-ish seconds
     # It's not a huge deal, but it might be beneficial to fix.
 
-    # Render the sidebar and get the values from it
-    _, filters, selected_genes = render_sidebar(lookup_df)
+    # Render the sidebar and get the values from it, a local dataset knows its values for autocompletion.
+    # The dataset and the gene lookup table load in the background, the page is drawn without them the first time
+    dataset_dir = os.getenv("LOCAL_DATASET")
+    store = local_backend.get_store(dataset_dir, wait=False) if dataset_dir else None
+    loading_dataset = bool(dataset_dir) and store is None
+    suggestions = store.suggestions() if store is not None else None
+    lookup = get_lookup()
+    genes, gene_index = (lookup[2], lookup[1]) if lookup is not None else (None, {})
+    _, filters, selected_genes = render_sidebar(genes, suggestions)
 
     max_pages = (st.session_state["total_number"] // PAGE_SIZE + 1) if st.session_state["total_number"] > 0 else 1
     # page button:
     cols = st.columns([2, 1, 2])
     page = cols[1].number_input("Page", min_value=1, max_value=max_pages, value=1, step=1)
 
-    st.session_state["filtered_df"], st.session_state["interactions_df"], st.session_state["total_number"] = process_data(
-        filters, selected_genes, lookup_df, page
-    )
+    # Queries to a local dataset would wait for it, they run again once it's loaded
+    if not loading_dataset:
+        st.session_state["filtered_df"], st.session_state["interactions_df"], st.session_state["total_number"] = process_data(
+            filters, selected_genes, gene_index, page
+        )
 
-    dataframe_columns = st.columns([1, 5, 1])
-    # Display the data
-    dataframe_columns[1].markdown(
-        f"Displaying **{len(st.session_state['filtered_df'])}** out of **{st.session_state['total_number']}** results"
-    )
-    dataframe_columns[1].dataframe(st.session_state["filtered_df"])
+    with span("render"):
+        dataframe_columns = st.columns([1, 5, 1])
+        if loading_dataset:
+            dataframe_columns[1].caption("Loading the local dataset...")
+        # Display the data
+        dataframe_columns[1].markdown(
+            f"Displaying **{len(st.session_state['filtered_df'])}** out of **{st.session_state['total_number']}** results"
+        )
+        dataframe_columns[1].dataframe(st.session_state["filtered_df"])
 
-    # TODO: st.dataframe(st.session_state["interactions_df"])
+        if not st.session_state["interactions_df"].empty:
+            dataframe_columns[1].markdown(f"**{len(st.session_state['interactions_df'])}** interactions")
+            dataframe_columns[1].dataframe(st.session_state["interactions_df"])
+
+        # Thumbnails made by xml_utils/thumbnails.py, instead of the full resolution images
+        manifest_path = os.getenv("IMAGE_MANIFEST")
+        if manifest_path and dataframe_columns[1].toggle("Show images"):
+            render_image_grid(st.session_state["filtered_df"], manifest_path, dataframe_columns[1])
 
     # Display download buttons / handle their clicks
     handle_downloads(filters, selected_genes)
 
+    # Time until a new session sees its first page (module imports excluded, see benchmarks/bench_startup.py)
+    if "first_render" not in st.session_state:
+        st.session_state["first_render"] = time.perf_counter() - started
+        observe("first_render_seconds", st.session_state["first_render"])
+
+    if os.getenv("DEBUG_METRICS"):
+        render_metrics()
+
+    if lookup is None or loading_dataset:
+        # Draw the page again once the gene list and the local dataset are there
+        get_lookup(wait=True)
+        if loading_dataset:
+            local_backend.get_store(dataset_dir)
+        st.rerun()
+
 
 if __name__ == "__main__":
     load_dotenv()
-    lookup_df = download_lookup_df()
-    main(lookup_df=lookup_df)
+    main()
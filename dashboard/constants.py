@@ -9,3 +9,23 @@ API_PATHS = {
 }
 
 PER_PAGE = 150
+EXPORT_LIMIT = 20_000  # rows the API allows in a single export
+EXPORT_PAGE_SIZE = 1_000  # entries fetched per request when streaming an export
+
+LOOKUP_URL = "https://www.proteinatlas.org/search?format=tsv"
+CACHE_DIR = "./cache"
+LOOKUP_TTL = 24 * 60 * 60  # seconds before the cached lookup table is revalidated
+
+POOL_SIZE = 10  # keep-alive connections to the API
+CACHED_REQUESTS = {"list"}  # exports are too big to keep around
+RESPONSE_CACHE_TTL = 30  # seconds an API answer is reused for identical queries
+RESPONSE_CACHE_SIZE = 256
+
+RESULT_CACHE_TTL = 300  # seconds a processed page is reused
+RESULT_CACHE_SIZE = 64
+
+IMAGE_SEPARATOR = ", "  # the image urls of an entry are joined with it in the displayed dataframe
+THUMBNAIL_WIDTH = 180  # pixels of a thumbnail in the image grid
+
+# Scrape the interactions of the selected genes from proteinatlas.org (one page per gene) on every new query
+FETCH_INTERACTIONS = False
@@ -1,22 +1,302 @@
+import os
+import json
+from threading import Lock
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
 import pandas as pd
-from utils import send_request, get_gene_xml_url, get_interactions_from_html
+import pyarrow as pa
+import pyarrow.compute as pc
+from metrics import inc, span
+from cachetools import TTLCache
+from utils import send_request, get_gene_xml_url
+from interaction_graph import EDGE_COLUMNS, InteractionGraph
+from constants import PER_PAGE, IMAGE_SEPARATOR, RESULT_CACHE_TTL, RESULT_CACHE_SIZE, FETCH_INTERACTIONS
+
+# Results shared across reruns, the next page is loaded in the background while the current one is shown
+_results = TTLCache(maxsize=RESULT_CACHE_SIZE, ttl=RESULT_CACHE_TTL)
+# Interactions don't depend on the page, they are cached on the selected genes and the interaction filters only
+_interactions = TTLCache(maxsize=RESULT_CACHE_SIZE, ttl=RESULT_CACHE_TTL)
+_prefetching = set()
+_prefetcher = ThreadPoolExecutor(max_workers=2)
+_lock = Lock()
+
+# displayed columns -> path of the field in an API entry
+ENTRY_COLUMNS = {
+    "staining": ["staining"],
+    "intensity": ["intensity"],  # FIXME: Grep failed
+    "quantity": ["quantity"],
+    "location": ["location"],
+    "patientId": ["patient", "id"],
+    "patientAge": ["patient", "age"],
+    "patientSex": ["patient", "sex"],
+    "geneName": ["gene", "name"],
+}
+CATEGORY_COLUMNS = ["staining", "intensity", "quantity", "location", "patientSex", "geneName"]
+
+# Only the fields that are read, anything else in an entry is ignored.
+# Explicit types also keep columns that are null on a whole page typed (and categorical) instead of null-typed
+PATIENT_TYPE = pa.struct([("id", pa.int64()), ("age", pa.int64()), ("sex", pa.string())])
+SAMPLE_TYPE = pa.struct([("img", pa.string()), ("tissueDescription", pa.string())])
+ENTRY_TYPE = pa.struct(
+    [
+        ("staining", pa.string()),
+        ("intensity", pa.string()),
+        ("quantity", pa.string()),
+        ("location", pa.string()),
+        ("patient", PATIENT_TYPE),
+        ("gene", pa.struct([("name", pa.string())])),
+        ("samples", pa.list_(SAMPLE_TYPE)),
+    ]
+)
+
+# Loaded once per process, streamlit reruns reuse it
+_graphs = {}
+
 
+def _coerce(value, arrow_type):
+    # e.g. a patient id sent as "1000" instead of 1000, values that can't be converted become null
+    if value is None:
+        return None
+    if pa.types.is_struct(arrow_type):
+        value = value if isinstance(value, dict) else {}
+        return {field.name: _coerce(value.get(field.name), field.type) for field in arrow_type}
+    if pa.types.is_list(arrow_type):
+        return [_coerce(item, arrow_type.value_type) for item in value] if isinstance(value, list) else None
+    if pa.types.is_integer(arrow_type):
+        try:
+            return int(value)
+        except (TypeError, ValueError):
+            return None
+    return str(value)
 
-def process_data(filters, selected_genes, lookup_df, page):
+
+def entries_to_array(data):
     """
-    Process the data based on the filters and selected genes
+    Read the entries into a struct array of type ENTRY_TYPE.
+
+    Entries are read as they are in a single C++ pass. Only when some field doesn't have the expected type,
+    they are converted field by field in Python first.
+    """
+    try:
+        return pa.array(data, type=ENTRY_TYPE)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        inc("entries_coerced", len(data))
+        return pa.array([_coerce(entry, ENTRY_TYPE) for entry in data], type=ENTRY_TYPE)
+
+
+@span("entries_to_frame")
+def entries_to_frame(data):
+    """
+    Convert the entries returned by the API into the displayed dataframe.
+
+    Every entry becomes one row, with its sample images joined into `images` and the longest
+    sample description as `tissue_description`. The conversion runs on arrow arrays instead of
+    looping over the entries, low-cardinality columns come out categorical.
+
+    Args:
+        data (list): The "data" list of an API response.
+
+    Returns:
+        pd.DataFrame: The filtered dataframe.
+    """
+    if len(data) == 0:
+        return pd.DataFrame()
+
+    entries = entries_to_array(data)
+
+    columns = {}
+    for column, path in ENTRY_COLUMNS.items():
+        values = entries
+        for field in path:
+            values = pc.struct_field(values, field)
+        columns[column] = values.dictionary_encode() if column in CATEGORY_COLUMNS else values
+
+    # Flatten the samples, keeping track of the entry each one belongs to
+    samples = entries.field("samples")
+    flat_samples = pc.list_flatten(samples)
+
+    # The first of the longest descriptions of each entry
+    descriptions = flat_samples.field("tissueDescription")
+    parents = pc.list_parent_indices(samples).to_numpy()
+    lengths = pc.utf8_length(descriptions).to_numpy(zero_copy_only=False)
+    order = np.lexsort((np.arange(len(parents)), -lengths, parents))
+    first = order[np.r_[True, parents[order][1:] != parents[order][:-1]]] if len(order) else order
+
+    tissue_description = np.full(len(data), "", dtype=object)
+    tissue_description[parents[first]] = descriptions.take(first).to_numpy(zero_copy_only=False)
+    columns["tissue_description"] = pa.array(tissue_description, type=pa.string())
+
+    images = pa.ListArray.from_arrays(samples.offsets, flat_samples.field("img"))
+    columns["images"] = pc.fill_null(pc.binary_join(images, IMAGE_SEPARATOR), "")
+
+    filtered_df = pa.table(columns).to_pandas()
+
+    return filtered_df
+
+
+def get_graph(graph_path):
+    if graph_path not in _graphs:
+        _graphs[graph_path] = InteractionGraph.load(graph_path)
+    return _graphs[graph_path]
+
+
+def interaction_filters(filters):
+    """
+    Translate the interaction filters of the sidebar into `InteractionGraph` filters.
+
+    Args:
+        filters (dict): A dictionary of the values of the filters.
+
+    Returns:
+        dict: Keyword arguments for `InteractionGraph.neighborhood` and `InteractionGraph.subgraph`.
+    """
+    interaction_type, confidence = filters.get("interaction_type", "Any"), filters.get("confidence", "Any")
+    low, high = filters.get("num_interactions", (0, 500))
+
+    return {
+        "types": None if interaction_type == "Any" else [interaction_type],
+        "confidences": None if confidence == "Any" else [confidence],
+        "mi_score": filters.get("mi_score", (0.0, 1.0)),
+        # The slider stops at 500, its maximum means "500 or more"
+        "num_interactions": (low, np.inf if high >= 500 else high),
+    }
+
+
+@span("get_interactions_df")
+def get_interactions_df(filters, selected_genes, gene_index):
+    """
+    Get the filtered interactions of the selected genes.
+
+    They come from the interaction graph saved by `xml_utils/interaction_graph.py` when INTERACTION_GRAPH is set,
+    otherwise from proteinatlas.org if FETCH_INTERACTIONS is on. Results are cached on (interaction filters,
+    selected_genes) for RESULT_CACHE_TTL seconds, every page of a query shares them.
+
+    Args:
+        filters (dict): A dictionary of the values of the filters.
+        selected_genes (list): A list of the selected genes.
+        gene_index (dict): The gene name -> ensembl id index, see `build_gene_index`.
+
+    Returns:
+        pd.DataFrame: The interactions dataframe.
+    """
+    key = json.dumps([interaction_filters(filters), selected_genes], sort_keys=True, default=str)
+    with _lock:
+        interactions = _interactions.get(key)
+
+    inc("interactions_cached" if interactions is not None else "interactions_computed")
+    if interactions is None:
+        interactions, complete = _get_interactions_df(filters, selected_genes, gene_index)
+        if complete:
+            with _lock:
+                _interactions[key] = interactions
+    return interactions
+
+
+def _get_interactions_df(filters, selected_genes, gene_index):
+    # returns (interactions, False if some genes couldn't be fetched and the result shouldn't be cached)
+    if len(selected_genes) == 0:
+        return pd.DataFrame(columns=EDGE_COLUMNS), True
+
+    graph_path = os.getenv("INTERACTION_GRAPH")
+    if graph_path:
+        return get_graph(graph_path).neighborhood(selected_genes, k=1, **interaction_filters(filters)), True
+
+    if FETCH_INTERACTIONS:
+        # The page parser (bs4, lxml) is only imported when interactions are scraped
+        from interactions import get_interactions
+
+        # All genes are fetched concurrently and concatenated once
+        gene_urls = {gene: get_gene_xml_url(gene, gene_index)[1] for gene in selected_genes}
+        interactions, failed = get_interactions(gene_urls)
+        if not interactions.empty:
+            graph = InteractionGraph.from_dataframe(interactions)
+            return graph.neighborhood(selected_genes, k=1, **interaction_filters(filters)), not failed
+        return pd.DataFrame(columns=EDGE_COLUMNS), not failed
+
+    return pd.DataFrame(columns=EDGE_COLUMNS), True
 
-    This function is called when the 'Apply Changes' button is clicked.
 
+def _result_key(filters, selected_genes, page):
+    return json.dumps([filters, selected_genes, page], sort_keys=True, default=str)
+
+
+def _load(key, filters, selected_genes, gene_index, page):
+    result, complete = _process_data(filters, selected_genes, gene_index, page)
+    if complete:
+        with _lock:
+            _results[key] = result
+    return result
+
+
+def _prefetch(filters, selected_genes, gene_index, page):
+    key = _result_key(filters, selected_genes, page)
+    with _lock:
+        if key in _results or key in _prefetching:
+            return
+        _prefetching.add(key)
+
+    def load():
+        try:
+            _load(key, filters, selected_genes, gene_index, page)
+        finally:
+            with _lock:
+                _prefetching.discard(key)
+
+    _prefetcher.submit(load)
+
+
+@span("process_data")
+def process_data(filters, selected_genes, gene_index, page):
+    """
+    Process the data based on the filters and selected genes, memoized.
+
+    Results are cached on (filters, selected_genes, page) for RESULT_CACHE_TTL seconds, least recently used
+    ones are evicted past RESULT_CACHE_SIZE. Streamlit reruns that don't change the query cost nothing,
+    and the next page is prefetched in the background.
 
     Args:
         filters (dict): A dictionary of the values of the filters.
         selected_genes (list): A list of the selected genes.
-        lookup_df (pd.DataFrame): The lookup dataframe. With the gene names and their corresponding XML URLs.
+        gene_index (dict): The gene name -> ensembl id index, see `build_gene_index`.
+        page (int): The page of results to fetch.
 
     Returns:
         filtered_df (pd.DataFrame): The filtered dataframe.
         interactions (pd.DataFrame): The interactions dataframe.
+        total_number (int): The number of results across all pages.
+    """
+    key = _result_key(filters, selected_genes, page)
+    with _lock:
+        result = _results.get(key)
+
+    inc("process_data_cached" if result is not None else "process_data_computed")
+    if result is None:
+        result = _load(key, filters, selected_genes, gene_index, page)
+
+    total_number = result[2]
+    if page * PER_PAGE < total_number:
+        _prefetch(filters, selected_genes, gene_index, page + 1)
+
+    return result
+
+
+def _process_data(filters, selected_genes, gene_index, page):
+    """
+    Process the data based on the filters and selected genes
+
+    This function is called when the 'Apply Changes' button is clicked.
+
+
+    Args:
+        filters (dict): A dictionary of the values of the filters.
+        selected_genes (list): A list of the selected genes.
+        gene_index (dict): The gene name -> ensembl id index, see `build_gene_index`.
+        page (int): The page of results to fetch.
+
+    Returns:
+        result (tuple): filtered_df, interactions and total_number, see `process_data`.
+        complete (bool): False if the request failed and the result shouldn't be cached.
 
     TODO: Communicate with the server with the selected genes and filters to get the filtered dataframe.
         We'll be using requests library to do this.
@@ -25,53 +305,19 @@ def process_data(filters, selected_genes, lookup_df, page):
     """
     # Perform the data processing only when the 'Apply Changes' button is clicked
 
-    interactions = pd.DataFrame(columns=["Interaction", "Interaction type", "Confidence", "MI score", "# Interactions"])
-    for gene in selected_genes:
-        break
-        # TODO: interactions from rest api
-        xml_url, interaction_url = get_gene_xml_url(gene, lookup_df)
-        interaction_df = get_interactions_from_html(gene=gene, url=interaction_url)
-        interactions = interactions.merge(interaction_df, how="outer")
+    # TODO: interactions from rest api
+    interactions = get_interactions_df(filters, selected_genes, gene_index)
 
     response = send_request(filters, "list", selected_genes=selected_genes, page=page)
 
     # If the response is not 200, return an empty dataframe
     if response.status_code != 200:
-        return pd.DataFrame(), interactions, 0
+        return (pd.DataFrame(), interactions, 0), False
 
-    response_data = response.json()
+    with span("json_decode"):
+        response_data = response.json()
 
     total_number = response_data["totalItems"]
-    data = response_data["data"]
-    processed_data = []
-
-    for entry in data:
-        entry_data = {
-            "staining": entry["staining"],
-            "intensity": entry["intensity"],  # FIXME: Grep failed
-            "quantity": entry["quantity"],
-            "location": entry["location"],
-            "patientId": entry["patient"]["id"],
-            "patientAge": entry["patient"]["age"],
-            "patientSex": entry["patient"]["sex"],
-            "geneName": entry["gene"]["name"],
-        }
-
-        images = []
-        tissue_description = ""
-
-        for sample in entry["samples"]:
-            images.append(sample["img"])
-            description = sample["tissueDescription"]
-
-            if len(description) > len(tissue_description):
-                tissue_description = description
-
-        entry_data["tissue_description"] = tissue_description
-        entry_data["images"] = ", ".join(images)
-
-        processed_data.append(entry_data)
-
-    filtered_df = pd.DataFrame(processed_data)
+    filtered_df = entries_to_frame(response_data["data"])
 
-    return filtered_df, interactions, total_number
+    return (filtered_df, interactions, total_number), True
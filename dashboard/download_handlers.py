@@ -1,9 +1,37 @@
+import os
 import base64
 import datetime
 
 import streamlit as st
 from utils import send_request
 from streamlit.components.v1 import html
+from exporters import ExportError, export_to_file
+
+EXCEL_MIME = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+
+
+def _export(filters, selected_genes, file_format, mime):
+    """
+    Build the export page by page into a temporary file and offer it as a regular file download.
+    Unlike the API exports there is no row limit.
+    """
+    try:
+        with st.spinner(f"Preparing samples.{file_format}..."):
+            path = export_to_file(filters, selected_genes, file_format)
+    except ExportError as e:
+        st.error(f"Failed to prepare samples.{file_format} file ({e})")
+        return
+
+    try:
+        with open(path, "rb") as file:
+            st.download_button(
+                f"Save samples.{file_format}",
+                data=file,
+                file_name=f"samples_{datetime.datetime.now().strftime('%x_%X')}.{file_format}",
+                mime=mime,
+            )
+    finally:
+        os.remove(path)
 
 
 def handle_downloads(filters, selected_genes):
@@ -25,45 +53,9 @@ def handle_downloads(filters, selected_genes):
     # Download the filtered dataframe as CSV
     col = st.columns([1, 1, 1, 1, 1])
 
-    if col[1].button("Download csv"):
-        response = send_request(filters, "csv", selected_genes=selected_genes)
-        if response.status_code == 200:
-            b64 = base64.b64encode(response.content).decode()
-            href = f'<a href="data:text/csv;base64,{b64}" download="samples_{datetime.datetime.now().strftime("%x_%X")}.csv">Download samples.csv file</a>'
-            html_content = f"""
-                    <script src="http://code.jquery.com/jquery-3.2.1.min.js"></script>
-                    <script>
-                    $('{href}')[0].click()
-                    </script>
-                    """
-            html(html_content)
-            st.success("Downloaded images.txt file")
-        else:
-            st.error(
-                "Failed to download samples.csv file"
-                if response.status_code != 413
-                else "Too many images, please apply more filters (pretty please(MAX=20_000))"
-            )
-
-    if col[2].button("Download xlsx"):
-        response = send_request(filters, "excel", selected_genes=selected_genes)
-        if response.status_code == 200:
-            b64 = base64.b64encode(response.content).decode()
-            href = f'<a href="data:file/xlsx;base64,{b64}" download="samples_{datetime.datetime.now().strftime("%x_%X")}.xlsx">Download samples.xlsx file</a>'
-            html_content = f"""
-                    <script src="http://code.jquery.com/jquery-3.2.1.min.js"></script>
-                    <script>
-                    $('{href}')[0].click()
-                    </script>
-                    """
-            html(html_content)
-            st.success("Downloaded samples.txt file")
-        else:
-            st.error(
-                "Failed to download samples.xlsx file"
-                if response.status_code != 413
-                else "Too many images, please apply more filters (pretty please(MAX=20_000))"
-            )
+    for column, (file_format, mime) in zip(col[1:3], [("csv", "text/csv"), ("xlsx", EXCEL_MIME)]):
+        if column.button(f"Download {file_format}"):
+            _export(filters, selected_genes, file_format, mime)
 
     # The image download functionality remains unchanged
     if col[3].button("Prepare Image download link"):
@@ -0,0 +1,130 @@
+"""Exports written page by page to a temporary file, so memory doesn't grow with the number of rows."""
+import os
+import tempfile
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+from utils import send_request
+from constants import EXPORT_PAGE_SIZE
+from local_backend import EXPORT_COLUMNS
+from data_processing import ENTRY_COLUMNS, entries_to_array
+
+
+class ExportError(Exception):
+    """Raised when the backend doesn't answer a page of the export."""
+
+
+def entries_to_export_frame(data):
+    """
+    Convert API entries into export rows: one row per sample image, with the columns of the API export
+    (mirrored by `local_backend.EXPORT_COLUMNS`).
+
+    Args:
+        data (list): The "data" list of an API response.
+
+    Returns:
+        pd.DataFrame: The export rows.
+    """
+    columns = list(EXPORT_COLUMNS.values())
+    if len(data) == 0:
+        return pd.DataFrame(columns=columns)
+
+    entries = entries_to_array(data)
+    samples = entries.field("samples")
+    flat_samples = pc.list_flatten(samples)
+    # the entry of every image
+    parents = pc.list_parent_indices(samples)
+
+    export = {}
+    # the entry fields are named the same in the export and the displayed table
+    for column in columns:
+        if column in ENTRY_COLUMNS:
+            values = entries
+            for field in ENTRY_COLUMNS[column]:
+                values = pc.struct_field(values, field)
+            export[column] = values.take(parents)
+    export["tissueDescription"] = flat_samples.field("tissueDescription")
+    export["image"] = flat_samples.field("img")
+
+    return pa.table({column: export[column] for column in columns}).to_pandas()
+
+
+def iter_export_pages(filters, selected_genes, per_page=EXPORT_PAGE_SIZE):
+    """
+    Page through every result of the query.
+
+    Args:
+        filters (dict): A dictionary of the values of the filters.
+        selected_genes (list): A list of the selected genes.
+        per_page (int): Entries fetched per request.
+
+    Yields:
+        pd.DataFrame: The export rows of one page of entries, see `entries_to_export_frame`.
+    """
+    page = 1
+    while True:
+        response = send_request(filters, "list", selected_genes=selected_genes, page=page, per_page=per_page, cache=False)
+        if response.status_code != 200:
+            raise ExportError(f"Page {page} of the export failed with status {response.status_code}")
+
+        response_data = response.json()
+        if len(response_data["data"]) == 0:
+            return
+        frame = entries_to_export_frame(response_data["data"])
+
+        yield frame
+
+        if page * per_page >= response_data["totalItems"]:
+            return
+        page += 1
+
+
+def write_csv(pages, path):
+    with open(path, "w", newline="") as file:
+        for i, frame in enumerate(pages):
+            frame.to_csv(file, header=i == 0, index=False)
+
+
+def write_xlsx(pages, path):
+    # openpyxl is slow to import, only Excel exports load it
+    from openpyxl import Workbook
+
+    # A write-only workbook streams rows to disk instead of keeping every cell in memory
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet("samples")
+
+    for i, frame in enumerate(pages):
+        if i == 0:
+            sheet.append(list(frame.columns))
+        for row in frame.astype(object).itertuples(index=False):
+            sheet.append([None if pd.isna(value) else value for value in row])
+
+    workbook.save(path)
+
+
+WRITERS = {"csv": write_csv, "xlsx": write_xlsx}
+
+
+def export_to_file(filters, selected_genes, file_format):
+    """
+    Write the whole query result to a temporary file.
+
+    Args:
+        filters (dict): A dictionary of the values of the filters.
+        selected_genes (list): A list of the selected genes.
+        file_format (str): "csv" or "xlsx".
+
+    Returns:
+        str: The path of the file, the caller is responsible for removing it.
+    """
+    file_descriptor, path = tempfile.mkstemp(suffix=f".{file_format}")
+    os.close(file_descriptor)
+
+    try:
+        WRITERS[file_format](iter_export_pages(filters, selected_genes), path)
+    except Exception:
+        os.remove(path)
+        raise
+
+    return path
@@ -0,0 +1,83 @@
+"""Thumbnail grid of the displayed entries, served from the image manifest and thumbnails written by xml_utils."""
+import os
+import hashlib
+import sqlite3
+from contextlib import closing
+
+import streamlit as st
+from metrics import inc, span
+from constants import IMAGE_SEPARATOR, THUMBNAIL_WIDTH
+
+
+def get_thumbnails(manifest_path, image_urls):
+    """
+    Find the local thumbnails of the images, see xml_utils/thumbnails.py.
+
+    Args:
+        manifest_path (str): The SQLite image manifest, opened read-only.
+        image_urls (list): The urls of the images.
+
+    Returns:
+        dict: {url: thumbnail path} for the images with a thumbnail, empty when there is no manifest yet.
+    """
+    if not image_urls or not os.path.exists(manifest_path):
+        return {}
+
+    try:
+        rows = _select_thumbnails(manifest_path, image_urls)
+    except sqlite3.DatabaseError:
+        # No thumbnails were made yet (no derivatives table) or the file isn't a manifest
+        inc("thumbnail_lookup_errors")
+        return {}
+
+    return dict(rows)
+
+
+def _select_thumbnails(manifest_path, image_urls):
+    with closing(sqlite3.connect(f"file:{manifest_path}?mode=ro", uri=True)) as db:
+        # A single query however many images the page has
+        db.execute("CREATE TEMP TABLE wanted (url_hash TEXT PRIMARY KEY)")
+        db.executemany(
+            "INSERT OR IGNORE INTO wanted VALUES (?)", ((hashlib.sha1(url.encode()).hexdigest(),) for url in image_urls)
+        )
+        rows = db.execute(
+            """
+            SELECT images.url, derivatives.path FROM images
+            JOIN wanted USING (url_hash)
+            JOIN derivatives ON derivatives.sha256 = images.sha256 AND derivatives.kind = 'thumbnail'
+            WHERE images.status = 'done'
+            """
+        ).fetchall()
+
+    return rows
+
+
+def render_image_grid(filtered_df, manifest_path, container=st):
+    """
+    Show the thumbnails of the images of the displayed entries, captioned with their gene and patient.
+    Images without a local thumbnail are only counted, full resolution images are never loaded here.
+
+    Args:
+        filtered_df (pd.DataFrame): The displayed entries, with their urls joined in `images`.
+        manifest_path (str): The SQLite image manifest.
+        container: Where to draw the grid.
+
+    Returns:
+        None
+    """
+    if filtered_df.empty:
+        return
+
+    with span("image_grid"):
+        captions = {}
+        for gene, patient_id, images in zip(filtered_df["geneName"], filtered_df["patientId"], filtered_df["images"]):
+            for url in images.split(IMAGE_SEPARATOR) if images else []:
+                captions.setdefault(url, f"{gene} · {patient_id}")
+
+        thumbnails = get_thumbnails(manifest_path, list(captions))
+        inc("thumbnails_shown", len(thumbnails))
+
+        if thumbnails:
+            container.image(list(thumbnails.values()), caption=[captions[url] for url in thumbnails], width=THUMBNAIL_WIDTH)
+        if len(thumbnails) < len(captions):
+            container.caption(f"{len(captions) - len(thumbnails)} of {len(captions)} images have no thumbnail yet")
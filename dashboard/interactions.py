@@ -0,0 +1,118 @@
+# Copy of xml_utils/interactions.py for correct imports in streamlit deployment
+import asyncio
+
+import bs4
+import requests
+import pandas as pd
+from requests.adapters import HTTPAdapter
+
+try:
+    import lxml.html
+except ImportError:
+    lxml = None
+
+INTERACTION_COLUMNS = ["Interaction", "Interaction type", "Confidence", "MI score", "# Interactions"]
+
+# Without lxml, only the interactions table is built into a bs4 tree, the rest of the page is skipped
+_TABLE_ONLY = bs4.SoupStrainer("table", class_="sortable")
+
+
+def _parse_with_lxml(html):
+    tables = lxml.html.fromstring(html).xpath("//table[contains(concat(' ', normalize-space(@class), ' '), ' sortable ')]")
+    if not tables:
+        return None, []
+
+    headers = ["".join(header.itertext()) for header in tables[0].find("thead").iter("th")]
+
+    # Same text as bs4's get_text(strip=True): every text node stripped, then joined
+    rows = [
+        ["".join(text.strip() for text in cell.itertext()) for cell in row.xpath(".//td | .//th")]
+        for row in tables[0].find("tbody").iter("tr")
+    ]
+
+    return headers, rows
+
+
+def parse_interactions_table(html: str):
+    """
+    returns the headers and rows of the interactions table, (None, []) if the page has none
+    """
+    if not html.strip():
+        return None, []
+    if lxml is not None:
+        return _parse_with_lxml(html)
+
+    table = bs4.BeautifulSoup(html, "html.parser", parse_only=_TABLE_ONLY).find("table")
+
+    if table is None:
+        return None, []
+
+    headers = [header.text for header in table.find("thead").find_all("th")]
+
+    # Both data cells and header cells
+    rows = [[cell.get_text(strip=True) for cell in row.find_all(["td", "th"])] for row in table.find("tbody").find_all("tr")]
+
+    return headers, rows
+
+
+def _to_dataframe(tables):
+    # tables is a list of (gene, headers, rows)
+    frames = [pd.DataFrame(rows, columns=headers).assign(gene=gene) for gene, headers, rows in tables if headers is not None]
+    if not frames:
+        return pd.DataFrame(columns=INTERACTION_COLUMNS)
+
+    df = pd.concat(frames, ignore_index=True)
+
+    # change column types for filtering
+    df["MI score"] = df["MI score"].astype(float)
+    df["# Interactions"] = df["# Interactions"].astype(int)
+
+    return df
+
+
+def get_interactions_from_html(gene: str, url: str) -> pd.DataFrame:
+    response = requests.get(url)
+    headers, rows = parse_interactions_table(response.text)
+    return _to_dataframe([(gene, headers, rows)])
+
+
+async def _fetch_interactions(session, semaphore, gene, url):
+    async with semaphore:
+        response = await asyncio.to_thread(session.get, url)
+    response.raise_for_status()
+    headers, rows = await asyncio.to_thread(parse_interactions_table, response.text)
+    return gene, headers, rows
+
+
+async def fetch_interactions(gene_urls: dict, max_connections: int = 8):
+    """
+    Fetch and parse the interactions of many genes concurrently.
+
+    At most `max_connections` requests are open at a time, over one pooled session.
+    The per-gene tables are concatenated once at the end.
+
+    returns (interactions dataframe, {gene: error} for the genes that failed)
+    """
+    session = requests.Session()
+    session.mount("https://", HTTPAdapter(pool_maxsize=max_connections))
+    session.mount("http://", HTTPAdapter(pool_maxsize=max_connections))
+    semaphore = asyncio.Semaphore(max_connections)
+
+    with session:
+        results = await asyncio.gather(
+            *(_fetch_interactions(session, semaphore, gene, url) for gene, url in gene_urls.items()), return_exceptions=True
+        )
+
+    failed = {
+        gene: f"{type(result).__name__}: {result}" for gene, result in zip(gene_urls, results) if isinstance(result, Exception)
+    }
+    tables = [result for result in results if not isinstance(result, Exception)]
+
+    return _to_dataframe(tables), failed
+
+
+def get_interactions(gene_urls: dict, max_connections: int = 8):
+    """
+    Blocking wrapper around `fetch_interactions`
+    """
+    return asyncio.run(fetch_interactions(gene_urls, max_connections))
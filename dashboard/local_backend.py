@@ -0,0 +1,292 @@
+"""Local stand-in for the API, answering the dashboard queries from the parquet dataset written by xml_utils."""
+import io
+import json
+from threading import Lock
+from urllib.parse import urlsplit
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from text_index import TextIndex
+from constants import EXPORT_LIMIT
+
+ENTRY_COLUMNS = ["gene", "patientId", "sex", "age", "staining", "intensity", "quantity", "location"]
+CATEGORY_COLUMNS = ["gene", "sex", "staining", "intensity", "quantity", "location"]
+
+EXPORT_COLUMNS = {
+    "gene": "geneName",
+    "patientId": "patientId",
+    "age": "patientAge",
+    "sex": "patientSex",
+    "staining": "staining",
+    "intensity": "intensity",
+    "quantity": "quantity",
+    "location": "location",
+    "tissueDescription": "tissueDescription",
+    "imageUrl": "image",
+}
+
+
+class LocalResponse:
+    """The parts of `requests.Response` the dashboard relies on."""
+
+    def __init__(self, status_code, content=b"", data=None):
+        self.status_code = status_code
+        self.content = content
+        self._data = data
+
+    def json(self):
+        return self._data if self._data is not None else json.loads(self.content)
+
+
+def _postings(column):
+    """
+    Build an inverted index of a categorical column.
+
+    Returns:
+        dict: category (None for missing values) -> sorted array of row positions.
+    """
+    codes = column.cat.codes.to_numpy()
+    order = np.argsort(codes, kind="stable")
+    bounds = np.searchsorted(codes[order], np.arange(-1, len(column.cat.categories) + 1))
+
+    postings = {None: order[bounds[0] : bounds[1]]}
+    for i, value in enumerate(column.cat.categories):
+        postings[value] = order[bounds[i + 1] : bounds[i + 2]]
+    return postings
+
+
+class LocalStore:
+    """
+    In-memory columnar store of the pathology records.
+
+    Rows are grouped into entries (one gene/patient combination with its samples), the unit the API pages over.
+    Gene, sex, staining, intensity, quantity and location have inverted indexes and age a sorted index,
+    so a query only touches the rows it selects. The location and tissue description texts have a `TextIndex`
+    over their distinct values.
+    """
+
+    def __init__(self, images, tissue_terms=None):
+        """
+        Args:
+            images (pd.DataFrame): One row per image, with the ENTRY_COLUMNS, "tissueDescription"
+                (the descriptions of the sample joined with ", ") and "imageUrl".
+            tissue_terms (dict): Single tissue description -> number of images, for suggestions.
+                Derived by splitting "tissueDescription" when not given.
+        """
+        for column in CATEGORY_COLUMNS + ["tissueDescription"]:
+            images[column] = images[column].astype("category")
+
+        # One entry per gene/patient combination, images sorted by entry
+        entry_ids = images.groupby(ENTRY_COLUMNS, sort=False, dropna=False, observed=True).ngroup().to_numpy()
+        order = np.argsort(entry_ids, kind="stable")
+        self.images = images.iloc[order].reset_index(drop=True)
+        self.image_entry = entry_ids[order]
+        self.entries = images.drop_duplicates(ENTRY_COLUMNS)[ENTRY_COLUMNS].reset_index(drop=True)
+        self.offsets = np.searchsorted(self.image_entry, np.arange(len(self.entries) + 1))
+        self.image_urls = self.images["imageUrl"].to_numpy(dtype=object)
+        self.image_descriptions = self.images["tissueDescription"].to_numpy(dtype=object)
+
+        self.postings = {column: _postings(self.entries[column]) for column in CATEGORY_COLUMNS}
+        self.postings["sex"] = {str(value).upper(): rows for value, rows in self.postings["sex"].items()}
+        self.patient_ids = self.entries["patientId"].to_numpy()
+
+        ages = self.entries["age"].to_numpy()
+        self.age_order = np.argsort(ages, kind="stable")
+        self.sorted_ages = ages[self.age_order]
+
+        locations = self.entries["location"]
+        # value_counts of a categorical follows the category order
+        self.location_index = TextIndex(locations.cat.categories, locations.value_counts(sort=False).to_numpy())
+        descriptions = self.images["tissueDescription"]
+        self.tissue_index = TextIndex(descriptions.cat.categories)
+
+        if tissue_terms is None:
+            tissue_terms = {}
+            for value, count in descriptions.value_counts().items():
+                for term in value.split(", "):
+                    tissue_terms[term] = tissue_terms.get(term, 0) + count
+        self.tissue_terms = TextIndex(list(tissue_terms), list(tissue_terms.values()))
+
+    @classmethod
+    def from_dataset(cls, dataset_dir):
+        table = pq.read_table(dataset_dir, columns=ENTRY_COLUMNS + ["tissueDescriptions", "imageUrl"])
+        descriptions = pc.binary_join(table.column("tissueDescriptions"), ", ")
+        term_counts = pc.value_counts(pc.list_flatten(table.column("tissueDescriptions"))).to_pylist()
+        table = table.drop_columns(["tissueDescriptions"]).append_column("tissueDescription", descriptions)
+        return cls(table.to_pandas(), {row["values"]: row["counts"] for row in term_counts if row["values"] is not None})
+
+    def _lookup(self, column, values):
+        postings = self.postings[column]
+        rows = [postings[value] for value in values if value in postings]
+        return np.concatenate(rows) if rows else np.empty(0, dtype=np.intp)
+
+    def _matching_location(self, text):
+        # Every comma separated term is a case-insensitive substring of the distinct values, then expand to rows
+        index = self.location_index
+        return self._lookup("location", [index.values[position] for position in index.search(text)])
+
+    def _matching_tissue(self, text):
+        descriptions = self.images["tissueDescription"]
+        matching = np.zeros(len(descriptions.cat.categories) + 1, dtype=bool)  # the extra slot is code -1 (missing)
+        matching[:-1] = self.tissue_index.mask(text)
+        return self.image_entry[matching[descriptions.cat.codes.to_numpy()]]
+
+    def suggestions(self):
+        """
+        Returns:
+            dict: The locations and the single tissue descriptions, most frequent first.
+        """
+        return {"location": self.location_index.suggest(), "tissue": self.tissue_terms.suggest()}
+
+    def select(self, params):
+        """
+        Args:
+            params (dict): The query parameters as sent to the API by `send_request`.
+
+        Returns:
+            np.ndarray: The positions of the matching entries.
+        """
+        selections = []
+
+        if "genes[]" in params:
+            selections.append(self._lookup("gene", params["genes[]"]))
+        if "patientId" in params:
+            selections.append(np.flatnonzero(self.patient_ids == str(params["patientId"])))
+        if "sex" in params:
+            selections.append(self._lookup("sex", [params["sex"].upper()]))
+        if "stainings[]" in params:
+            selections.append(self._lookup("staining", params["stainings[]"]))
+        if "intensities[]" in params:
+            selections.append(self._lookup("intensity", params["intensities[]"]))
+        if "quantities[]" in params:
+            # "None" is sent as None by `build_query`, the parser keeps the text "None" of the XML
+            quantities = [quantity for quantity in params["quantities[]"] if quantity is not None]
+            if len(quantities) < len(params["quantities[]"]):
+                quantities += [None, "None"]
+            selections.append(self._lookup("quantity", quantities))
+        if "location" in params:
+            selections.append(self._matching_location(params["location"]))
+        if "tissueDescription" in params:
+            selections.append(self._matching_tissue(params["tissueDescription"]))
+
+        # ageTo is sent as a 1-tuple
+        age_from, age_to = params.get("ageFrom", 0), np.ravel(params.get("ageTo", 200))[0]
+        low = np.searchsorted(self.sorted_ages, age_from, side="left")
+        high = np.searchsorted(self.sorted_ages, age_to, side="right")
+        selections.append(self.age_order[low:high])
+
+        mask = np.ones(len(self.entries), dtype=bool)
+        for rows in selections:
+            selected = np.zeros(len(self.entries), dtype=bool)
+            selected[rows] = True
+            mask &= selected
+
+        return np.flatnonzero(mask)
+
+    def page(self, entry_ids, page, per_page):
+        page_ids = entry_ids[(page - 1) * per_page : page * per_page]
+        entries = self.entries.iloc[page_ids].astype(object)
+        entries = entries.where(entries.notna(), None)
+
+        data = []
+        for entry_id, entry in zip(page_ids, entries.itertuples(index=False)):
+            images = slice(self.offsets[entry_id], self.offsets[entry_id + 1])
+            data.append(
+                {
+                    "staining": entry.staining,
+                    "intensity": entry.intensity,
+                    "quantity": entry.quantity,
+                    "location": entry.location,
+                    "patient": {"id": int(entry.patientId), "age": int(entry.age), "sex": entry.sex},
+                    "gene": {"name": entry.gene},
+                    "samples": [
+                        {"img": url, "tissueDescription": description}
+                        for url, description in zip(self.image_urls[images], self.image_descriptions[images])
+                    ],
+                }
+            )
+        return data
+
+    def export(self, entry_ids):
+        """
+        Returns:
+            pd.DataFrame: One row per image of the selected entries, with the API export column names.
+        """
+        selected = np.zeros(len(self.entries), dtype=bool)
+        selected[entry_ids] = True
+        images = self.images[selected[self.image_entry]]
+        return images[list(EXPORT_COLUMNS)].rename(columns=EXPORT_COLUMNS)
+
+
+# Loaded once per process, in the background: streamlit reruns reuse it and the first page doesn't wait for it
+_store_loader = ThreadPoolExecutor(max_workers=1)
+_stores = {}
+_lock = Lock()
+
+
+def get_store(dataset_dir, wait=True):
+    """
+    Start loading the dataset on the first call and return it once it's there.
+
+    Args:
+        dataset_dir (str): The parquet dataset written by `xml_utils/record_store.py`.
+        wait (bool): Block until the dataset is loaded.
+
+    Returns:
+        LocalStore: The loaded dataset, or None while it's still loading.
+    """
+    with _lock:
+        if dataset_dir not in _stores:
+            _stores[dataset_dir] = _store_loader.submit(LocalStore.from_dataset, dataset_dir)
+        store = _stores[dataset_dir]
+
+    if not (wait or store.done()):
+        return None
+    try:
+        return store.result()
+    except Exception:
+        # Try again on the next call, e.g. when the dataset was being rewritten
+        with _lock:
+            if _stores.get(dataset_dir) is store:
+                del _stores[dataset_dir]
+        raise
+
+
+def query(dataset_dir, request_type, params):
+    """
+    Answer a request the way the API would.
+
+    Args:
+        dataset_dir (str): The parquet dataset written by `xml_utils/record_store.py`.
+        request_type (str): One of the `API_PATHS` keys.
+        params (dict): The query parameters built by `send_request`.
+
+    Returns:
+        LocalResponse: A response with the same status codes and payloads as the API.
+    """
+    store = get_store(dataset_dir)
+    entry_ids = store.select(params)
+
+    if request_type == "list":
+        data = store.page(entry_ids, int(params.get("page", 1)), int(params.get("perPage", len(entry_ids))))
+        return LocalResponse(200, data={"totalItems": len(entry_ids), "data": data})
+
+    export = store.export(entry_ids)
+    if len(export) > EXPORT_LIMIT:
+        return LocalResponse(413)
+
+    buffer = io.BytesIO()
+    if request_type == "csv":
+        export.to_csv(buffer, index=False)
+    elif request_type == "excel":
+        export.to_excel(buffer, index=False)
+    elif request_type == "images":
+        # PaTho expects paths relative to the image server
+        paths = [urlsplit(url).path.lstrip("/") for url in export["image"].unique()]
+        buffer.write("\n".join(paths).encode())
+    else:
+        return LocalResponse(404)
+
+    return LocalResponse(200, content=buffer.getvalue())
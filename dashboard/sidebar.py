@@ -1,12 +1,14 @@
 import streamlit as st
 
 
-def render_sidebar(lookup_df):
+def render_sidebar(genes, suggestions=None):
     """
     Render the sidebar and return the values from it.
 
     Args:
-        lookup_df (pd.DataFrame): The lookup dataframe.
+        genes (list): The sorted gene names, None while the lookup table is still loading.
+        suggestions (dict): Known "location" and "tissue" description values, most frequent first.
+            When given, these filters autocomplete instead of being free text.
 
     Returns:
         submit_button (streamlit.form_submit_button): The 'Apply Changes' button. Used to determine if the button was clicked in the `app.py` file.
@@ -20,10 +22,14 @@ def render_sidebar(lookup_df):
 
             st.title("Filter main dataframe")
 
-            # Gene selection multiselect
-            genes = lookup_df["gene"].unique()
-            genes.sort()
-            selected_genes = st.multiselect(label="Select genes", options=genes, default=[])
+            # Gene selection multiselect, disabled until the gene list is there
+            selected_genes = st.multiselect(
+                label="Select genes",
+                options=genes or [],
+                default=[],
+                disabled=genes is None,
+                placeholder="Loading genes..." if genes is None else "Choose an option",
+            )
 
             # Text input for patient ID
             patient_id = st.text_input("Patient ID")
@@ -45,27 +51,34 @@ def render_sidebar(lookup_df):
             quantity_options = ["75%-25%", ">75%", "None", "<25%"]
             quantity = st.multiselect("Quantity", quantity_options, default=[])
 
-            # Text input for location
-            location = st.text_input("Location")
+            if suggestions:
+                # Selectbox for location, typing filters the options
+                location = st.selectbox("Location", [""] + suggestions["location"], index=0)
 
-            # Multiselect for tissue descriptions
-            tissue_descriptions = st.text_input("Tissue Descriptions")
+                # Multiselect for tissue descriptions, samples have to match all the selected ones
+                tissue_descriptions = ", ".join(st.multiselect("Tissue Descriptions", options=suggestions["tissue"], default=[]))
+            else:
+                # Text input for location
+                location = st.text_input("Location")
 
-            # st.title("Filter interactions dataframe")
+                # Text input for tissue descriptions, comma separated terms
+                tissue_descriptions = st.text_input("Tissue Descriptions")
 
-            # # Selectbox for interaction type
-            # interaction_type_options = ["Any", "Physical association", "Direct interaction"]
-            # interaction_type = st.selectbox("Interaction type", interaction_type_options, index=0)
+            st.title("Filter interactions dataframe")
 
-            # # Selectbox for confidence
-            # confidence_options = ["Any", "High", "Medium", "Low"]
-            # confidence = st.selectbox("Confidence", confidence_options, index=0)
+            # Selectbox for interaction type
+            interaction_type_options = ["Any", "Physical association", "Direct interaction"]
+            interaction_type = st.selectbox("Interaction type", interaction_type_options, index=0)
 
-            # # Slider for MI score for floats between 0 and 1
-            # mi_score = st.slider("MI score", 0.0, 1.0, (0.0, 1.0))
+            # Selectbox for confidence
+            confidence_options = ["Any", "High", "Medium", "Low"]
+            confidence = st.selectbox("Confidence", confidence_options, index=0)
 
-            # # Slider for # Interactions
-            # num_interactions = st.slider("# Interactions", 0, 500, (0, 500))
+            # Slider for MI score for floats between 0 and 1
+            mi_score = st.slider("MI score", 0.0, 1.0, (0.0, 1.0))
+
+            # Slider for # Interactions
+            num_interactions = st.slider("# Interactions", 0, 500, (0, 500))
 
     # Return the values from the sidebar
     filters = {
@@ -77,10 +90,10 @@ def render_sidebar(lookup_df):
         "quantity": quantity,
         "location": location,
         "selected_tissues": tissue_descriptions,
-        # "interaction_type": interaction_type,
-        # "confidence": confidence,
-        # "mi_score": mi_score,
-        # "num_interactions": num_interactions,
+        "interaction_type": interaction_type,
+        "confidence": confidence,
+        "mi_score": mi_score,
+        "num_interactions": num_interactions,
     }
 
     return submit_button, filters, selected_genes
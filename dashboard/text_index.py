@@ -0,0 +1,136 @@
+"""Trigram and word-prefix index over the distinct values of a text column."""
+import re
+import bisect
+from functools import reduce
+
+import numpy as np
+
+WORD = re.compile(r"\w+")
+TERM_SEPARATOR = ","
+
+
+def _trigrams(text):
+    return {text[i : i + 3] for i in range(len(text) - 2)}
+
+
+def split_terms(query):
+    """
+    Split a query into its comma separated terms, lowercased, empty ones dropped.
+    """
+    return [term.strip().lower() for term in query.split(TERM_SEPARATOR) if term.strip()]
+
+
+class TextIndex:
+    """
+    Case-insensitive index over a list of distinct strings, e.g. the categories of a column.
+
+    Queries return positions in `values`, rows are found from there with the column's category codes,
+    so the cost depends on the number of distinct strings, not on the number of rows.
+    Substring terms are answered by intersecting trigram postings and checking the few candidates left,
+    prefix terms by a binary search over the sorted words.
+    """
+
+    def __init__(self, values, weights=None):
+        """
+        Args:
+            values (list): The distinct strings.
+            weights (list): How often each value occurs, used to rank suggestions. Defaults to 1 for all.
+        """
+        self.values = list(values)
+        self.lowered = [value.lower() for value in self.values]
+        self.weights = np.ones(len(self.values)) if weights is None else np.asarray(weights, dtype=float)
+
+        postings = {}
+        for position, value in enumerate(self.lowered):
+            for gram in _trigrams(value):
+                postings.setdefault(gram, []).append(position)
+        self.postings = {gram: np.array(positions, dtype=np.int64) for gram, positions in postings.items()}
+
+        words = sorted({(word, position) for position, value in enumerate(self.lowered) for word in WORD.findall(value)})
+        self.words = [word for word, _ in words]
+        self.word_positions = np.array([position for _, position in words], dtype=np.int64)
+
+    def __len__(self):
+        return len(self.values)
+
+    def substring(self, term):
+        """
+        Returns:
+            np.ndarray: Sorted positions of the values containing `term`.
+        """
+        term = term.lower()
+        if len(term) < 3:
+            candidates = np.arange(len(self.values))
+        else:
+            grams = [self.postings.get(gram) for gram in _trigrams(term)]
+            if any(gram is None for gram in grams):
+                return np.empty(0, dtype=np.int64)
+            # smallest postings first, the intersection shrinks fastest
+            candidates = reduce(np.intersect1d, sorted(grams, key=len))
+
+        return np.array([position for position in candidates if term in self.lowered[position]], dtype=np.int64)
+
+    def _word_prefix(self, word):
+        low = bisect.bisect_left(self.words, word)
+        high = bisect.bisect_left(self.words, word + "\U0010ffff")
+        return np.unique(self.word_positions[low:high])
+
+    def prefix(self, term):
+        """
+        Returns:
+            np.ndarray: Sorted positions of the values with a word starting with each word of `term`,
+                e.g. "duct carc" matches "Duct carcinoma".
+        """
+        words = WORD.findall(term.lower())
+        if not words:
+            return np.arange(len(self.values))
+        return reduce(np.intersect1d, sorted((self._word_prefix(word) for word in words), key=len))
+
+    def search(self, query, prefix=False):
+        """
+        Match every comma separated term of `query`.
+
+        Args:
+            query (str): e.g. "breast, duct carcinoma".
+            prefix (bool): Match terms as word prefixes instead of substrings.
+
+        Returns:
+            np.ndarray: Sorted positions of the values matching all terms.
+        """
+        terms = split_terms(query)
+        if not terms:
+            return np.arange(len(self.values))
+
+        match = self.prefix if prefix else self.substring
+        # smallest results first, the intersection shrinks fastest
+        return reduce(np.intersect1d, sorted((match(term) for term in terms), key=len))
+
+    def mask(self, query, prefix=False):
+        """
+        Returns:
+            np.ndarray: Boolean mask over `values`.
+        """
+        mask = np.zeros(len(self.values), dtype=bool)
+        mask[self.search(query, prefix)] = True
+        return mask
+
+    def suggest(self, text="", limit=None):
+        """
+        Values for autocompletion: those with a word starting with `text` first, then those only containing it,
+        each group by decreasing weight.
+
+        Returns:
+            list: Up to `limit` values, all of them if `text` is empty and `limit` None.
+        """
+        text = text.strip().lower()
+        if not text:
+            order = np.argsort(-self.weights, kind="stable")
+            return [self.values[position] for position in order[:limit]]
+
+        prefixed = self.prefix(text)
+        contained = np.setdiff1d(self.substring(text), prefixed)
+        suggestions = []
+        for positions in (prefixed, contained):
+            order = positions[np.argsort(-self.weights[positions], kind="stable")]
+            suggestions += [self.values[position] for position in order]
+        return suggestions[:limit]
@@ -1,16 +1,31 @@
 import os
+import json
+import time
 from io import StringIO
+from threading import Lock
+from concurrent.futures import Future, ThreadPoolExecutor
 
-import bs4
 import requests
 import pandas as pd
-from constants import PER_PAGE, API_PATHS
-
-
-def send_request(filters, request_type, df=None, selected_genes=None, page=1):
-    url = os.getenv("API_URL")
-
-    filtered_filters = {"perPage": PER_PAGE, "page": page}
+import local_backend
+from metrics import inc, span
+from cachetools import TTLCache
+from requests.adapters import HTTPAdapter
+from constants import (
+    PER_PAGE,
+    API_PATHS,
+    CACHE_DIR,
+    POOL_SIZE,
+    LOOKUP_TTL,
+    LOOKUP_URL,
+    CACHED_REQUESTS,
+    RESPONSE_CACHE_TTL,
+    RESPONSE_CACHE_SIZE,
+)
+
+
+def build_query(filters, selected_genes, page=1, per_page=PER_PAGE):
+    filtered_filters = {"perPage": per_page, "page": page}
 
     if len(selected_genes) > 0:
         filtered_filters["genes[]"] = selected_genes
@@ -39,33 +54,181 @@ def send_request(filters, request_type, df=None, selected_genes=None, page=1):
     if filters["selected_tissues"] != "":
         filtered_filters["tissueDescription"] = filters["selected_tissues"]
 
-    response = requests.get(url + API_PATHS[request_type], filtered_filters)
+    return filtered_filters
+
+
+# Shared by every session and rerun: keeps connections to the API alive and remembers recent answers
+_session = requests.Session()
+_session.mount("http://", HTTPAdapter(pool_maxsize=POOL_SIZE))
+_session.mount("https://", HTTPAdapter(pool_maxsize=POOL_SIZE))
+_responses = TTLCache(maxsize=RESPONSE_CACHE_SIZE, ttl=RESPONSE_CACHE_TTL)
+_in_flight = {}
+_lock = Lock()
+
+
+def _get(request_type, params, cache=True):
+    """
+    GET an API path, coalescing identical concurrent requests into one and
+    reusing successful "list" responses for RESPONSE_CACHE_TTL seconds (unless `cache` is False).
+    """
+    key = (request_type, json.dumps(params, sort_keys=True, default=str))
+
+    with _lock:
+        if key in _responses:
+            return _responses[key]
+        future = _in_flight.get(key)
+        owner = future is None
+        if owner:
+            future = _in_flight[key] = Future()
+
+    # Someone else is already asking the same thing, wait for their answer
+    if not owner:
+        return future.result()
+
+    try:
+        response = _session.get(os.getenv("API_URL") + API_PATHS[request_type], params=params)
+        if cache and response.status_code == 200 and request_type in CACHED_REQUESTS:
+            with _lock:
+                _responses[key] = response
+        future.set_result(response)
+        return response
+    except Exception as e:
+        future.set_exception(e)
+        raise
+    finally:
+        with _lock:
+            del _in_flight[key]
+
+
+@span("send_request")
+def send_request(filters, request_type, df=None, selected_genes=None, page=1, per_page=PER_PAGE, cache=True):
+    filtered_filters = build_query(filters, selected_genes, page, per_page)
+
+    # Serve the request from a local dataset instead of the API when one is configured
+    dataset_dir = os.getenv("LOCAL_DATASET")
+    if dataset_dir:
+        return local_backend.query(dataset_dir, request_type, filtered_filters)
+
+    response = _get(request_type, filtered_filters, cache)
+    inc("api_bytes", len(response.content))
 
     return response
 
 
+def _load_lookup():
+    lookup_df = download_lookup_df()
+    return lookup_df, build_gene_index(lookup_df), sorted(lookup_df["gene"].unique())
+
+
+# The lookup table is loaded once per process, in the background: the first page doesn't wait for it
+_lookup_loader = ThreadPoolExecutor(max_workers=1)
+_lookup = None
+
+
+def get_lookup(wait=False):
+    """
+    Start loading the gene lookup table on the first call, from the local snapshot when it's fresh
+    (see `download_lookup_df`), and return it once it's there.
+
+    Args:
+        wait (bool): Block until the table is loaded.
+
+    Returns:
+        tuple: (lookup dataframe, {gene: ensembl id}, sorted gene names), or None while it's still loading.
+    """
+    global _lookup
+    with _lock:
+        if _lookup is None:
+            _lookup = _lookup_loader.submit(_load_lookup)
+        lookup = _lookup
+
+    if not (wait or lookup.done()):
+        return None
+    try:
+        return lookup.result()
+    except Exception:
+        # Try again on the next call, e.g. when proteinatlas.org was unreachable
+        with _lock:
+            if _lookup is lookup:
+                _lookup = None
+        raise
+
+
 # Copies from xml utils for correct imports in streamlit deployment
 # =================================================================
-def download_lookup_df():
-    # Download the data
-    response = requests.get("https://www.proteinatlas.org/search?format=tsv")
+def _fetch_lookup_df(etag=None):
+    # Download the data, unless it hasn't changed since the cached copy
+    headers = {"If-None-Match": etag} if etag else {}
+    response = requests.get(LOOKUP_URL, headers=headers)
+    if response.status_code == 304:
+        return None, etag
     response.raise_for_status()
 
-    # Convert the downloaded data to a DataFrame
+    # Convert the downloaded data to a DataFrame, only 'Gene' and 'Ensembl' columns are needed
     data = StringIO(response.text)
-    query_df = pd.read_csv(data, sep="\t")
-
-    # Create a subset with only 'Gene' and 'Ensembl' columns
+    query_df = pd.read_csv(data, sep="\t", usecols=["Gene", "Ensembl"])
     lookup_df = query_df[["Gene", "Ensembl"]].rename(columns={"Gene": "gene", "Ensembl": "ensembl"})
 
+    return lookup_df, response.headers.get("ETag")
+
+
+def download_lookup_df(cache_dir: str = CACHE_DIR, ttl: float = LOOKUP_TTL) -> pd.DataFrame:
+    """
+    returns the gene/ensembl lookup dataframe
+
+    The table is kept as a parquet snapshot in `cache_dir`. Within `ttl` seconds of the last check
+    it is read from disk only, after that it is revalidated with the stored ETag.
+    A stale snapshot is used when proteinatlas.org can't be reached.
+    """
+    table_path = os.path.join(cache_dir, "lookup.parquet")
+    meta_path = os.path.join(cache_dir, "lookup.json")
+
+    cached = os.path.exists(table_path) and os.path.exists(meta_path)
+    meta = {}
+    if cached:
+        with open(meta_path) as file:
+            meta = json.load(file)
+        if time.time() - meta["checked_at"] < ttl:
+            return pd.read_parquet(table_path)
+
+    try:
+        lookup_df, etag = _fetch_lookup_df(meta.get("etag"))
+    except requests.RequestException:
+        if cached:
+            return pd.read_parquet(table_path)
+        raise
+
+    os.makedirs(cache_dir, exist_ok=True)
+    if lookup_df is None:
+        lookup_df = pd.read_parquet(table_path)
+    else:
+        lookup_df.to_parquet(f"{table_path}.tmp", index=False)
+        os.replace(f"{table_path}.tmp", table_path)
+
+    with open(f"{meta_path}.tmp", "w") as file:
+        json.dump({"etag": etag, "checked_at": time.time()}, file)
+    os.replace(f"{meta_path}.tmp", meta_path)
+
     return lookup_df
 
 
-def get_gene_xml_url(gene: str, lookup_df: pd.DataFrame, version: str = "latest"):
+def build_gene_index(lookup_df: pd.DataFrame) -> dict:
+    """
+    returns {gene: ensembl id}, keeping the first id of genes listed more than once
+    """
+    return dict(zip(lookup_df["gene"].iloc[::-1], lookup_df["ensembl"].iloc[::-1]))
+
+
+def get_gene_xml_url(gene: str, lookup: dict | pd.DataFrame, version: str = "latest"):
     """
     returns links to xml and interactions
+
+    `lookup` is either the index from `build_gene_index` or the lookup dataframe itself (slower)
     """
-    ensembl_id = lookup_df.loc[lookup_df["gene"] == gene, "ensembl"].iat[0]
+    if isinstance(lookup, pd.DataFrame):
+        ensembl_id = lookup.loc[lookup["gene"] == gene, "ensembl"].iat[0]
+    else:
+        ensembl_id = lookup[gene]
     return version_to_xml_url(ensembl_id, version), version_to_interactions_url(ensembl_id, gene, version)
 
 
@@ -77,39 +240,3 @@ def version_to_xml_url(ensembl_id: str, version: str = "latest") -> str:
 def version_to_interactions_url(ensembl_id: str, gene: str, version: str = "latest") -> str:
     version = "www" if version == "latest" else version
     return f"https://{version}.proteinatlas.org/{ensembl_id}-{gene}/interaction"
-
-
-def get_interactions_from_html(gene: str, url: str) -> pd.DataFrame:
-    response = requests.get(url)
-
-    parsed = bs4.BeautifulSoup(response.text, "html.parser")
-
-    # dataframe of interactions
-    table = parsed.find("table", class_="sortable")
-
-    if table is None:
-        return pd.DataFrame(columns=["Interaction", "Interaction type", "Confidence", "MI score", "# Interactions"])
-
-    headers = [header.text for header in table.find("thead").find_all("th")]
-
-    rows = table.find("tbody").find_all("tr")
-
-    # Initialize an empty list to store the data
-    data = []
-
-    # Iterate through the rows and extract data
-    for row in rows:
-        cells = row.find_all(["td", "th"])  # Both data cells and header cells
-        row_data = [cell.get_text(strip=True) for cell in cells]
-        data.append(row_data)
-
-    gene_list = [gene] * len(rows)
-    # Create a Pandas DataFrame
-    df = pd.DataFrame(data, columns=headers)
-    df["gene"] = gene_list
-
-    # change column types for filtering
-    df["MI score"] = df["MI score"].astype(float)
-    df["# Interactions"] = df["# Interactions"].astype(int)
-
-    return df
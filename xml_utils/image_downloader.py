@@ -1,43 +1,268 @@
+import io
 import os
+import time
+import hashlib
 import zipfile
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
 
 import requests
+from metrics import inc, span
+from requests.adapters import HTTPAdapter
+from image_manifest import IMAGE_MANIFEST, ImageManifest
 
+CHUNK_SIZE = 64 * 1024
 
-def download_images(image_urls):
-    # Ensure there's a directory to save the images
-    os.makedirs("images", exist_ok=True)
 
-    # List to hold the file paths of downloaded images
-    image_files = []
+def make_session(pool_size=8):
+    # A single session keeps connections alive and shares them between the download threads
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def _with_url_hash(name, url):
+    stem, extension = os.path.splitext(name)
+    return f"{stem}_{hashlib.sha1(url.encode()).hexdigest()[:8]}{extension}"
+
+
+def image_file_names(image_urls):
+    """
+    returns {url: file name}, urls that share a basename get a short hash of the url appended
+    so they don't overwrite each other
+    """
+    # Get the image file name from the URL or create one if it doesn't exist
+    base_names = {url: url.split("/")[-1] or f"image_{i}.jpg" for i, url in enumerate(dict.fromkeys(image_urls), start=1)}
+    counts = Counter(base_names.values())
+
+    file_names = {}
+    for url, name in base_names.items():
+        if counts[name] > 1:
+            name = _with_url_hash(name, url)
+        file_names[url] = name
+
+    return file_names
+
+
+def _file_sha256(path, digest=None):
+    digest = digest or hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest
+
+
+def _fetch_image(session, url, file_path, timeout):
+    """
+    returns (file path, size, sha256 of the content)
+    """
+    # Skip files that are already there, unless the server reports a different size
+    if os.path.exists(file_path):
+        head = session.head(url, allow_redirects=True, timeout=timeout)
+        size = head.headers.get("Content-Length")
+        if not head.ok or size is None or int(size) == os.path.getsize(file_path):
+            inc("images_skipped")
+            return file_path, os.path.getsize(file_path), _file_sha256(file_path).hexdigest()
 
-    # Download each image
-    for i, url in enumerate(image_urls, start=1):
-        response = requests.get(url, stream=True)
+    # Resume from a partial download left behind by an earlier run
+    part_path = f"{file_path}.part"
+    offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    headers = {"Range": f"bytes={offset}-"} if offset else {}
+
+    with session.get(url, stream=True, headers=headers, timeout=timeout) as response:
+        if response.status_code == 416:
+            # The partial file doesn't match the remote one anymore, start over
+            os.remove(part_path)
+            return _fetch_image(session, url, file_path, timeout)
         response.raise_for_status()  # Check for request errors
 
-        # Get the image file name from the URL or create one if it doesn't exist
-        image_file_name = url.split("/")[-1] or f"image_{i}.jpg"
-        image_file_path = os.path.join("images", image_file_name)
+        mode = "ab" if response.status_code == 206 else "wb"
+        # The checksum is computed while writing, a resumed download starts from the bytes already there
+        digest = _file_sha256(part_path) if mode == "ab" else hashlib.sha256()
+        with open(part_path, mode) as file:
+            for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                file.write(chunk)
+                digest.update(chunk)
+            size = file.tell()
+            inc("image_bytes", size - (offset if mode == "ab" else 0))
+
+    # Only complete files ever get the final name
+    os.replace(part_path, file_path)
+    return file_path, size, digest.hexdigest()
+
+
+def _fetch_image_content(session, url, timeout):
+    response = session.get(url, timeout=timeout)
+    response.raise_for_status()  # Check for request errors
+    return response.content
+
+
+def _with_retries(function, retries, backoff, *args):
+    for attempt in range(retries + 1):
+        try:
+            return function(*args)
+        except requests.RequestException:
+            if attempt == retries:
+                raise
+            time.sleep(backoff * 2**attempt)
+
+
+def download_images(
+    image_urls, folder="images", max_workers=8, retries=3, backoff=0.5, timeout=30, session=None, manifest=IMAGE_MANIFEST
+):
+    """
+    Download images concurrently into `folder`.
+
+    Every url is downloaded once: urls repeated in `image_urls` or already recorded in the `manifest`
+    (see `ImageManifest`) by an earlier run, for any gene and into any folder, are not requested again
+    and the recorded file is returned. Otherwise files already present with the size reported by the server
+    are skipped, interrupted downloads are resumed from their `.part` file.
+    Failed requests are retried with exponential backoff.
+
+    returns the file paths of the images, in the order of `image_urls`
+    """
+    # Ensure there's a directory to save the images
+    os.makedirs(folder, exist_ok=True)
+
+    inc("images_requested", len(image_urls))
+    with span("download_images"), ImageManifest(manifest) as image_manifest:
+        # Files deleted since they were recorded are downloaded again
+        known = {url: image["path"] for url, image in image_manifest.lookup(image_urls).items() if os.path.exists(image["path"])}
+        file_names = image_file_names(url for url in image_urls if url not in known)
+        # A file recorded for another url (same basename, earlier run or other gene) is never reused
+        owners = image_manifest.owners(os.path.join(folder, name) for name in file_names.values())
+        for url, name in file_names.items():
+            if owners.get(os.path.abspath(os.path.join(folder, name)), url) != url:
+                file_names[url] = _with_url_hash(name, url)
+        inc("images_deduplicated", len(image_urls) - len(file_names))
 
-        # Save the image to the local directory
-        with open(image_file_path, "wb") as file:
-            for chunk in response.iter_content(chunk_size=8192):
-                if chunk:
-                    file.write(chunk)
-                    file.flush()
-                    os.fsync(file.fileno())
+        session = session or make_session(max_workers)
+        with ThreadPoolExecutor(max_workers) as executor:
+            downloads = {
+                url: executor.submit(
+                    _with_retries, _fetch_image, retries, backoff, session, url, os.path.join(folder, name), timeout
+                )
+                for url, name in file_names.items()
+            }
 
-        image_files.append(image_file_path)
+            downloaded, failures = [], []
+            for url, download in downloads.items():
+                try:
+                    downloaded.append((url, *download.result()))
+                except requests.RequestException as e:
+                    failures.append((url, str(e)))
+
+        # Record what succeeded before reporting the failure, the next run won't fetch it again
+        image_manifest.add_many(downloaded)
+        image_manifest.add_failures(failures)
+        if failures:
+            downloads[failures[0][0]].result()
+
+    known.update((url, path) for url, path, _, _ in downloaded)
+    # List to hold the file paths of downloaded images
+    image_files = [known[url] for url in image_urls]
 
     return image_files
 
 
-def zip_images(image_files):
+def zip_images(image_files=None, compression=zipfile.ZIP_STORED, image_urls=None, manifest=IMAGE_MANIFEST):
+    """
+    Zip the given files, or the downloaded images of `image_urls` as recorded in the `manifest`
+    (all of them when both are None)
+    """
+    if image_files is None:
+        with ImageManifest(manifest) as image_manifest:
+            image_files = image_manifest.paths(image_urls)
+
     # Create a zip file containing all images
     zip_file_path = "images.zip"
-    with zipfile.ZipFile(zip_file_path, "w") as zipf:
+    with zipfile.ZipFile(zip_file_path, "w", compression=compression) as zipf:
         for file in image_files:
             zipf.write(file, arcname=os.path.basename(file))
 
     return zip_file_path
+
+
+def write_images_txt(image_urls=None, path="images.txt", manifest=IMAGE_MANIFEST):
+    """
+    Write the images.txt read by PaTho for the downloaded images of `image_urls` (all of them if None)
+    """
+    with ImageManifest(manifest) as image_manifest, open(path, "w") as file:
+        file.write(image_manifest.images_txt(image_urls))
+    return path
+
+
+def _iter_image_contents(image_urls, max_workers, retries, backoff, timeout, session):
+    """
+    yields (url, content) in the order of `image_urls`, downloading ahead with at most
+    2 * max_workers images held in memory
+    """
+    session = session or make_session(max_workers)
+    with ThreadPoolExecutor(max_workers) as executor:
+        window = deque()
+        for url in image_urls:
+            window.append((url, executor.submit(_with_retries, _fetch_image_content, retries, backoff, session, url, timeout)))
+            if len(window) >= 2 * max_workers:
+                url, future = window.popleft()
+                yield url, future.result()
+
+        while window:
+            url, future = window.popleft()
+            yield url, future.result()
+
+
+def zip_images_stream(
+    image_urls, fileobj, compression=zipfile.ZIP_STORED, max_workers=8, retries=3, backoff=0.5, timeout=30, session=None
+):
+    """
+    Write the images straight from the network into a zip, nothing is staged on disk.
+
+    `fileobj` can be any writable binary file object, seekable or not (a socket, a pipe, ...).
+    JPEGs barely compress, so entries are STORED by default, pass `zipfile.ZIP_DEFLATED` to compress.
+    """
+    file_names = image_file_names(image_urls)
+    contents = _iter_image_contents(file_names, max_workers, retries, backoff, timeout, session)
+
+    with zipfile.ZipFile(fileobj, "w", compression=compression) as zipf:
+        for url, content in contents:
+            zipf.writestr(file_names[url], content)
+
+    return fileobj
+
+
+class _ChunkSink(io.RawIOBase):
+    # Unseekable file object that collects whatever zipfile writes into it
+    def __init__(self):
+        super().__init__()
+        self.chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self):
+        chunks, self.chunks = self.chunks, []
+        return chunks
+
+
+def iter_zip_images(image_urls, compression=zipfile.ZIP_STORED, max_workers=8, retries=3, backoff=0.5, timeout=30, session=None):
+    """
+    Same as `zip_images_stream`, but yields the zip as byte chunks as it is built,
+    e.g. to serve it as a streamed HTTP response
+    """
+    file_names = image_file_names(image_urls)
+    contents = _iter_image_contents(file_names, max_workers, retries, backoff, timeout, session)
+
+    sink = _ChunkSink()
+    with zipfile.ZipFile(sink, "w", compression=compression) as zipf:
+        for url, content in contents:
+            zipf.writestr(file_names[url], content)
+            yield from sink.drain()
+
+    # The central directory is written when the zip is closed
+    yield from sink.drain()
@@ -0,0 +1,159 @@
+import os
+import time
+import hashlib
+import sqlite3
+from urllib.parse import urlsplit
+
+from metrics import inc
+from xml_loader import CACHE_DIR
+
+IMAGE_MANIFEST = os.path.join(CACHE_DIR, "images.sqlite")
+MMAP_SIZE = 256 * 2**20  # bytes of the database file read through a memory map instead of read() calls
+DONE, FAILED = "done", "failed"
+
+
+def url_hash(url: str) -> str:
+    return hashlib.sha1(url.encode()).hexdigest()
+
+
+class ImageManifest:
+    """
+    Every image downloaded so far, in an SQLite database shared by all runs and genes.
+
+    One row per url (keyed by its sha1): the file it was saved to, its size, the sha256 of its content
+    and whether the download succeeded. Questions like "which of these urls still have to be downloaded"
+    or "which files make up this zip" are answered from here, without looking at the image folders.
+    """
+
+    def __init__(self, path: str = IMAGE_MANIFEST):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self.db = sqlite3.connect(path, timeout=60)
+        # WAL lets the dashboard read while a download writes
+        self.db.execute("PRAGMA journal_mode = WAL")
+        self.db.execute(f"PRAGMA mmap_size = {MMAP_SIZE}")
+        self.db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS images (
+                url_hash TEXT PRIMARY KEY,
+                url TEXT NOT NULL,
+                path TEXT,
+                size INTEGER,
+                sha256 TEXT,
+                status TEXT NOT NULL,
+                error TEXT,
+                updated_at REAL NOT NULL
+            )
+            """
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS images_sha256 ON images (sha256)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS images_path ON images (path)")
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return self.db.execute("SELECT COUNT(*) FROM images WHERE status = ?", (DONE,)).fetchone()[0]
+
+    def _select(self, columns, image_urls):
+        # Join against a temporary table of the url hashes, a single query however many urls there are
+        with self.db:
+            self.db.execute("CREATE TEMP TABLE IF NOT EXISTS wanted (url_hash TEXT PRIMARY KEY)")
+            self.db.execute("DELETE FROM wanted")
+            self.db.executemany("INSERT OR IGNORE INTO wanted VALUES (?)", ((url_hash(url),) for url in image_urls))
+            return self.db.execute(
+                f"SELECT {columns} FROM images JOIN wanted USING (url_hash) WHERE images.status = ?", (DONE,)
+            ).fetchall()
+
+    def lookup(self, image_urls) -> dict:
+        """
+        returns {url: {"path", "size", "sha256"}} for the urls of `image_urls` that were downloaded
+        """
+        return {
+            url: {"path": path, "size": size, "sha256": sha256}
+            for url, path, size, sha256 in self._select("url, path, size, sha256", image_urls)
+        }
+
+    def missing(self, image_urls) -> list:
+        """
+        returns the urls of `image_urls` that were never downloaded or failed, in order and without duplicates
+        """
+        done = {url for (url,) in self._select("url", image_urls)}
+        return [url for url in dict.fromkeys(image_urls) if url not in done]
+
+    def owners(self, paths) -> dict:
+        """
+        returns {path: url} for the file paths of `paths` that are recorded for an image
+        """
+        with self.db:
+            self.db.execute("CREATE TEMP TABLE IF NOT EXISTS wanted_paths (path TEXT PRIMARY KEY)")
+            self.db.execute("DELETE FROM wanted_paths")
+            self.db.executemany("INSERT OR IGNORE INTO wanted_paths VALUES (?)", ((os.path.abspath(path),) for path in paths))
+            return dict(self.db.execute("SELECT path, url FROM images JOIN wanted_paths USING (path)").fetchall())
+
+    def add(self, url: str, path: str, size: int, sha256: str) -> None:
+        self.add_many([(url, path, size, sha256)])
+
+    def add_many(self, images) -> None:
+        """
+        Record downloaded images, `images` is an iterable of (url, path, size, sha256).
+        """
+        now = time.time()
+        with self.db:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO images VALUES (?, ?, ?, ?, ?, ?, NULL, ?)",
+                ((url_hash(url), url, os.path.abspath(path), size, sha256, DONE, now) for url, path, size, sha256 in images),
+            )
+
+    def add_failures(self, failures) -> None:
+        """
+        Record failed downloads, `failures` is an iterable of (url, error message). Successful downloads are kept.
+        """
+        failures = list(failures)
+        now = time.time()
+        with self.db:
+            self.db.executemany(
+                """
+                INSERT INTO images (url_hash, url, status, error, updated_at) VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT (url_hash) DO UPDATE SET status = excluded.status, error = excluded.error, updated_at = excluded.updated_at
+                WHERE images.status != ?
+                """,
+                ((url_hash(url), url, FAILED, error, now, DONE) for url, error in failures),
+            )
+        inc("images_failed", len(failures))
+
+    def remove(self, image_urls) -> None:
+        # e.g. for files that were deleted from disk
+        with self.db:
+            self.db.executemany("DELETE FROM images WHERE url_hash = ?", ((url_hash(url),) for url in image_urls))
+
+    def paths(self, image_urls=None) -> list:
+        """
+        returns the file paths of the downloaded images of `image_urls` (all of them if None), in order
+        """
+        if image_urls is None:
+            return [path for (path,) in self.db.execute("SELECT path FROM images WHERE status = ? ORDER BY rowid", (DONE,))]
+        found = self.lookup(image_urls)
+        return [found[url]["path"] for url in dict.fromkeys(image_urls) if url in found]
+
+    def urls(self) -> list:
+        return [url for (url,) in self.db.execute("SELECT url FROM images WHERE status = ? ORDER BY rowid", (DONE,))]
+
+    def images_txt(self, image_urls=None) -> str:
+        """
+        returns the images.txt file read by PaTho (`PaTho -f images.txt -b http://images.proteinatlas.org/`):
+        one path relative to the image server per line, for the downloaded images of `image_urls` (all of them if None)
+        """
+        if image_urls is None:
+            urls = self.urls()
+        else:
+            found = self.lookup(image_urls)
+            urls = [url for url in dict.fromkeys(image_urls) if url in found]
+        # PaTho expects paths relative to the image server
+        return "\n".join(urlsplit(url).path.lstrip("/") for url in urls)
@@ -0,0 +1,304 @@
+import os
+import sys
+import gzip
+import json
+import tempfile
+from contextlib import ExitStack
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, ProcessPoolExecutor, wait
+
+import pandas as pd
+from metrics import inc, span
+from image_downloader import make_session
+from xml_cache import fetch_xml, object_digest
+from xml_parser import iter_patient_info, process_xml_stream
+from record_store import DATASET_DIR, write_records, delete_records
+from xml_loader import build_gene_index, download_lookup_df, version_to_dump_url
+
+SNAPSHOT_FILE = "_snapshot.json"  # the leading underscore keeps it out of the parquet dataset
+DUMP_BATCH_SIZE = 200_000  # records per write when ingesting the whole dump
+
+
+def download_gene_xml(gene: str, gene_index: dict, version: str = "latest", session=None, in_use=None) -> str:
+    # Served from the XML cache when possible, the parser reads the compressed file directly.
+    # The entry is added to `in_use` first, so that other downloads don't evict it before it is parsed
+    if in_use is not None:
+        in_use.add((gene_index[gene], version))
+    return fetch_xml(gene_index[gene], version, session=session, in_use=in_use or ())
+
+
+def parse_gene_xml(file_name: str):
+    """
+    returns (records, problems the parser recovered from), see `iter_patient_info`
+
+    raises ValueError when the file couldn't be read to the end (e.g. truncated), its records would be incomplete
+    """
+    errors = []
+    records = process_xml_stream(file_name, errors)
+    for error in errors:
+        if error.get("fatal"):
+            raise ValueError(f"unreadable XML, {error['error']}")
+    return records, errors
+
+
+def _fail(status, stage, error):
+    status["status"] = "failed"
+    status["stage"] = stage
+    status["error"] = f"{type(error).__name__}: {error}"
+
+
+def _handle_download(future, status, unchanged_digest, cpu_pool):
+    """
+    returns the parse future of a downloaded file, None if the download failed or the file is unchanged
+    """
+    try:
+        file_name = future.result()
+    except Exception as e:
+        _fail(status, "download", e)
+        return None
+
+    status["file"] = file_name
+    status["digest"] = object_digest(file_name)
+    if unchanged_digest == status["digest"]:
+        status["status"] = "unchanged"
+        return None
+
+    # start parsing the file as soon as its download is done
+    return cpu_pool.submit(parse_gene_xml, file_name)
+
+
+@span("ingest_genes")
+def ingest_genes(genes, lookup_df, version="latest", download_workers=16, parse_workers=None, on_records=None, unchanged=None):
+    """
+    Download and parse the XMLs of many genes.
+
+    Downloads run in a thread pool and every finished file is handed straight to a process pool
+    for parsing, so network and CPU work overlap. A gene that fails (unknown symbol, HTTP error,
+    unparseable XML, ...) is reported and skipped, the rest of the run carries on. Files are parsed in recovering mode:
+    invalid characters are repaired and unreadable patients skipped, those problems are listed in "parse_errors".
+    A file that is still broken (e.g. truncated) fails the gene at the "parse" stage.
+
+    Args:
+        genes (list): Gene names to ingest, duplicates are ingested once.
+        lookup_df (pd.DataFrame): The gene -> ensembl lookup dataframe.
+        version (str): HPA version, "latest" or e.g. "v23".
+        download_workers (int): Number of concurrent downloads.
+        parse_workers (int): Number of parser processes, defaults to the number of cores.
+        on_records (callable): Called as `on_records(gene, records)` for each parsed gene, as soon as it is parsed.
+            When given, records are not kept in memory: a gene's records are dropped once `on_records` returns.
+        unchanged (dict): gene -> digest of the XML it was last ingested from. Genes whose XML still has
+            that digest are reported as "unchanged" and not parsed.
+
+    Returns:
+        records (dict): gene -> list of records as returned by `process_xml`, empty if `on_records` is given.
+        report (list): One {"gene", "status", "stage", "error", "records", "file", "digest", "parse_errors"} dict per gene.
+    """
+    genes = list(dict.fromkeys(genes))
+    gene_index = build_gene_index(lookup_df)
+    session = make_session(download_workers)
+    unchanged = unchanged or {}
+    report = {
+        gene: {
+            "gene": gene,
+            "status": "ok",
+            "stage": None,
+            "error": None,
+            "records": 0,
+            "file": None,
+            "digest": None,
+            "parse_errors": [],
+        }
+        for gene in genes
+    }
+    records = {}
+    # (ensembl_id, version) of the files downloaded and not parsed yet, the XML cache keeps them
+    in_use = set()
+
+    with ThreadPoolExecutor(download_workers) as io_pool, ProcessPoolExecutor(parse_workers or os.cpu_count()) as cpu_pool:
+        # future -> (stage, gene), downloads and parses are handled in one loop in the order they finish
+        tasks = {
+            io_pool.submit(download_gene_xml, gene, gene_index, version, session, in_use): ("download", gene) for gene in genes
+        }
+
+        while tasks:
+            finished, _ = wait(tasks, return_when=FIRST_COMPLETED)
+            for future in finished:
+                # a handled future is dropped, with it the records it holds
+                stage, gene = tasks.pop(future)
+                if stage == "download":
+                    parse = _handle_download(future, report[gene], unchanged.get(gene), cpu_pool)
+                    if parse is not None:
+                        tasks[parse] = ("parse", gene)
+                    else:
+                        in_use.discard((gene_index.get(gene), version))
+                    continue
+
+                in_use.discard((gene_index.get(gene), version))
+
+                try:
+                    gene_records, report[gene]["parse_errors"] = future.result()
+                except Exception as e:
+                    _fail(report[gene], "parse", e)
+                    continue
+
+                report[gene]["records"] = len(gene_records)
+                if on_records is None:
+                    records[gene] = gene_records
+                    continue
+
+                try:
+                    on_records(gene, gene_records)
+                except Exception as e:
+                    _fail(report[gene], "write", e)
+
+    for status in report.values():
+        inc(f"genes_{status['status']}")
+    return records, list(report.values())
+
+
+def load_snapshot(dataset_dir: str = DATASET_DIR) -> dict:
+    """
+    returns gene -> {"digest", "version", "partitions"} of the last ingestion into `dataset_dir`
+    """
+    try:
+        with open(os.path.join(dataset_dir, SNAPSHOT_FILE)) as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return {}
+
+
+def save_snapshot(snapshot: dict, dataset_dir: str = DATASET_DIR) -> None:
+    os.makedirs(dataset_dir, exist_ok=True)
+    with tempfile.NamedTemporaryFile("w", dir=dataset_dir, suffix=".tmp", prefix="_", delete=False) as file:
+        json.dump(snapshot, file, indent=1, sort_keys=True)
+    os.replace(file.name, os.path.join(dataset_dir, SNAPSHOT_FILE))
+
+
+def update_dataset(genes, lookup_df, version="latest", dataset_dir=DATASET_DIR, **kwargs):
+    """
+    Incrementally bring the dataset in `dataset_dir` to `version`.
+
+    Every XML is still fetched (a cached "latest" one only costs a revalidation), but only genes whose XML
+    digest differs from the snapshot of the previous run are parsed and have their partitions rewritten.
+    Rows of unchanged genes keep the version they were first ingested from.
+    Genes that fail are left as they were and retried on the next run.
+
+    Args:
+        genes (list): Gene names to ingest.
+        lookup_df (pd.DataFrame): The gene -> ensembl lookup dataframe.
+        version (str): HPA version, "latest" or e.g. "v23".
+        dataset_dir (str): The parquet dataset, partitioned by gene.
+        **kwargs: Passed on to `ingest_genes`.
+
+    Returns:
+        report (list): The report of `ingest_genes`.
+    """
+    snapshot = load_snapshot(dataset_dir)
+    partitions = {}
+
+    def on_records(gene, gene_records):
+        # Partitions the gene doesn't have anymore are removed, the others replaced
+        written = sorted({record["gene_names"][0] for record in gene_records})
+        delete_records(set(snapshot.get(gene, {}).get("partitions", [])) - set(written), dataset_dir)
+        write_records(gene_records, dataset_dir, version)
+        partitions[gene] = written
+
+    unchanged = {gene: entry["digest"] for gene, entry in snapshot.items()}
+    _, report = ingest_genes(genes, lookup_df, version, on_records=on_records, unchanged=unchanged, **kwargs)
+
+    for status in report:
+        if status["status"] == "ok":
+            snapshot[status["gene"]] = {"digest": status["digest"], "version": version, "partitions": partitions[status["gene"]]}
+    save_snapshot(snapshot, dataset_dir)
+
+    return report
+
+
+def _open_dump(source, stack, session):
+    if not source.startswith(("http://", "https://")):
+        return source  # a local path, .gz files are decompressed by the parser
+
+    response = stack.enter_context((session or make_session(1)).get(source, stream=True))
+    response.raise_for_status()
+    # The file itself is gzip compressed (not the transfer), decompress while reading the socket
+    return stack.enter_context(gzip.GzipFile(fileobj=response.raw)) if source.endswith(".gz") else response.raw
+
+
+def _split_batch(batch, written):
+    # A symbol can have several entries in the dump, records of a gene written by an earlier batch are added to its partition
+    fresh = [record for record in batch if record["gene_names"][0] not in written]
+    repeated = [record for record in batch if record["gene_names"][0] in written]
+    written.update(record["gene_names"][0] for record in fresh)
+    return fresh, repeated
+
+
+def _write(fresh, repeated, dataset_dir, version):
+    write_records(fresh, dataset_dir, version)
+    write_records(repeated, dataset_dir, version, append=True)
+
+
+@span("ingest_dump")
+def ingest_dump(source=None, version="latest", dataset_dir=DATASET_DIR, batch_size=DUMP_BATCH_SIZE, session=None):
+    """
+    Ingest every gene from the single HPA dump (proteinatlas.xml.gz) instead of one XML per gene.
+
+    The dump is streamed and decompressed on the fly and parsed entry by entry with `iter_patient_info`
+    in recovering mode, so neither the file nor the tree is ever fully in memory. Records are written
+    in batches of about `batch_size`, cut between genes. A gene symbol shared by several entries of the dump
+    (see `build_gene_index`) may span batches, its later records are appended to the partition.
+    Writing happens in a background thread while the next batch is parsed.
+
+    Partitions of the genes in the dump are replaced, their entries in the incremental snapshot are dropped
+    so the next `update_dataset` checks them again.
+
+    Args:
+        source (str): URL or local path of the dump, defaults to `version_to_dump_url(version)`.
+        version (str): HPA version the records are labelled with.
+        dataset_dir (str): The parquet dataset, partitioned by gene.
+        batch_size (int): Records per write.
+        session (requests.Session): Session used to download the dump.
+
+    Returns:
+        dict: {"genes", "records", "parse_errors"}.
+    """
+    source = source or version_to_dump_url(version)
+    errors, genes, written, batch = [], set(), set(), []
+    records = 0
+    pending = None
+
+    with ExitStack() as stack:
+        writer = stack.enter_context(ThreadPoolExecutor(max_workers=1))
+        dump = _open_dump(source, stack, session)
+
+        for record in iter_patient_info(dump, errors):
+            gene = record["gene_names"][0]
+            if gene not in genes:
+                # a new gene starts, hand the finished ones over if the batch is full
+                if len(batch) >= batch_size:
+                    if pending is not None:
+                        pending.result()  # at most one batch waits for the writer
+                    pending = writer.submit(_write, *_split_batch(batch, written), dataset_dir, version)
+                    batch = []
+                genes.add(gene)
+            batch.append(record)
+            records += 1
+
+        if pending is not None:
+            pending.result()
+        _write(*_split_batch(batch, written), dataset_dir, version)
+
+    snapshot = load_snapshot(dataset_dir)
+    if any(gene in snapshot for gene in genes):
+        save_snapshot({gene: entry for gene, entry in snapshot.items() if gene not in genes}, dataset_dir)
+
+    return {"genes": len(genes), "records": records, "parse_errors": errors}
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] == ["--dump"]:
+        print(ingest_dump())
+        sys.exit()
+
+    genes = sys.argv[1:] or ["EGFR", "TP53", "ANGPTL8"]
+    lookup_df = download_lookup_df()
+    report = update_dataset(genes, lookup_df)
+    print(pd.DataFrame(report))
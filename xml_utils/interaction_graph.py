@@ -0,0 +1,158 @@
+import numpy as np
+import pandas as pd
+
+EDGE_COLUMNS = ["gene", "Interaction", "Interaction type", "Confidence", "MI score", "# Interactions"]
+
+
+class InteractionGraph:
+    """
+    Protein interactions in compressed sparse row (CSR) form.
+
+    Genes are numbered in sorted order, the partners of gene `i` are `indices[indptr[i]:indptr[i + 1]]`
+    and every edge attribute is an array aligned with `indices`. Interactions are symmetric, so each
+    one is stored in both directions. Interaction types and confidences are stored as small integer codes.
+    """
+
+    def __init__(self, genes, indptr, indices, types, type_names, confidences, confidence_names, mi_scores, counts):
+        self.genes = genes
+        self.gene_ids = {gene: i for i, gene in enumerate(genes)}
+        self.indptr = indptr
+        self.indices = indices
+        self.types = types
+        self.type_names = type_names
+        self.confidences = confidences
+        self.confidence_names = confidence_names
+        self.mi_scores = mi_scores
+        self.counts = counts
+
+    @classmethod
+    def from_dataframe(cls, interactions: pd.DataFrame) -> "InteractionGraph":
+        """
+        Build the graph from interactions as returned by `get_interactions`
+        (one row per gene/partner with type, confidence, MI score and count).
+        """
+        forward = interactions[EDGE_COLUMNS].set_axis(["source", "target", "type", "confidence", "mi", "count"], axis=1)
+        backward = forward.rename(columns={"source": "target", "target": "source"})
+        edges = pd.concat([forward, backward], ignore_index=True).drop_duplicates(["source", "target", "type"])
+
+        genes = np.unique(np.concatenate([edges["source"].to_numpy(dtype=str), edges["target"].to_numpy(dtype=str)]))
+        sources = np.searchsorted(genes, edges["source"].to_numpy(dtype=str))
+        targets = np.searchsorted(genes, edges["target"].to_numpy(dtype=str))
+
+        order = np.lexsort((targets, sources))
+        types = pd.Categorical(edges["type"])
+        confidences = pd.Categorical(edges["confidence"])
+
+        return cls(
+            genes=genes,
+            indptr=np.searchsorted(sources[order], np.arange(len(genes) + 1)).astype(np.int64),
+            indices=targets[order].astype(np.int32),
+            types=types.codes[order].astype(np.int8),
+            type_names=np.asarray(types.categories, dtype=str),
+            confidences=confidences.codes[order].astype(np.int8),
+            confidence_names=np.asarray(confidences.categories, dtype=str),
+            mi_scores=edges["mi"].to_numpy(dtype=np.float32)[order],
+            counts=edges["count"].to_numpy(dtype=np.int32)[order],
+        )
+
+    def save(self, path: str) -> None:
+        np.savez_compressed(
+            path,
+            genes=self.genes,
+            indptr=self.indptr,
+            indices=self.indices,
+            types=self.types,
+            type_names=self.type_names,
+            confidences=self.confidences,
+            confidence_names=self.confidence_names,
+            mi_scores=self.mi_scores,
+            counts=self.counts,
+        )
+
+    @classmethod
+    def load(cls, path: str) -> "InteractionGraph":
+        with np.load(path) as arrays:
+            return cls(**{name: arrays[name] for name in arrays.files})
+
+    def _edge_mask(self, types=None, confidences=None, mi_score=(0.0, 1.0), num_interactions=(0, np.inf)):
+        """
+        returns a boolean mask over all edges, None for a filter means "any"
+        """
+        mask = (self.mi_scores >= mi_score[0]) & (self.mi_scores <= mi_score[1])
+        mask &= (self.counts >= num_interactions[0]) & (self.counts <= num_interactions[1])
+        if types is not None:
+            mask &= np.isin(self.types, np.flatnonzero(np.isin(self.type_names, types)))
+        if confidences is not None:
+            mask &= np.isin(self.confidences, np.flatnonzero(np.isin(self.confidence_names, confidences)))
+        return mask
+
+    def _edges_of(self, nodes):
+        # positions of every edge leaving `nodes`, without a python loop over the nodes
+        starts, stops = self.indptr[nodes], self.indptr[nodes + 1]
+        lengths = stops - starts
+        offsets = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+        return np.arange(lengths.sum()) + offsets
+
+    def _to_dataframe(self, edges):
+        sources = np.searchsorted(self.indptr, edges, side="right") - 1
+        return pd.DataFrame(
+            {
+                "gene": self.genes[sources],
+                "Interaction": self.genes[self.indices[edges]],
+                "Interaction type": self.type_names[self.types[edges]],
+                "Confidence": self.confidence_names[self.confidences[edges]],
+                "MI score": self.mi_scores[edges].astype(float),
+                "# Interactions": self.counts[edges].astype(int),
+            }
+        )
+
+    def neighborhood(self, genes: list, k: int = 1, **filters) -> pd.DataFrame:
+        """
+        returns the edges reachable within `k` hops of `genes`, only following edges that pass `filters`
+        (types, confidences, mi_score range, num_interactions range)
+        """
+        mask = self._edge_mask(**filters)
+
+        visited = np.zeros(len(self.genes), dtype=bool)
+        frontier = np.array([self.gene_ids[gene] for gene in genes if gene in self.gene_ids], dtype=np.int64)
+        visited[frontier] = True
+        collected = []
+
+        for _ in range(k):
+            if len(frontier) == 0:
+                break
+            edges = self._edges_of(frontier)
+            edges = edges[mask[edges]]
+            collected.append(edges)
+
+            targets = np.unique(self.indices[edges])
+            frontier = targets[~visited[targets]]
+            visited[frontier] = True
+
+        edges = np.concatenate(collected) if collected else np.empty(0, dtype=np.int64)
+        return self._to_dataframe(edges)
+
+    def subgraph(self, genes: list = None, **filters) -> pd.DataFrame:
+        """
+        returns every edge passing `filters`, limited to edges between `genes` when given
+        """
+        mask = self._edge_mask(**filters)
+        if genes is not None:
+            members = np.isin(self.genes, genes)
+            mask &= members[self.indices] & np.repeat(members, np.diff(self.indptr))
+        return self._to_dataframe(np.flatnonzero(mask))
+
+
+if __name__ == "__main__":
+    import sys
+
+    from interactions import get_interactions
+    from xml_loader import CACHE_DIR, build_gene_index, get_gene_xml_url, download_lookup_df
+
+    genes = sys.argv[1:] or ["SLC2A3", "EGFR", "TP53"]
+    gene_index = build_gene_index(download_lookup_df())
+    interactions, failed = get_interactions({gene: get_gene_xml_url(gene, gene_index)[1] for gene in genes})
+
+    graph = InteractionGraph.from_dataframe(interactions)
+    graph.save(f"{CACHE_DIR}/interactions.npz")
+    print(graph.neighborhood(genes[:1], k=2, confidences=["High"]))
@@ -0,0 +1,136 @@
+import json
+import math
+import time
+import bisect
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+# upper bounds of the histogram buckets, in seconds for spans
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, math.inf)
+RECENT_SPANS = 200  # finished spans kept for inspection
+
+
+class Histogram:
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Registry:
+    """
+    Process-wide counters, histograms and spans.
+
+    `span(name)` times a block (or a function, as a decorator) into the `<name>_seconds` histogram.
+    Spans opened inside another one on the same thread record it as their parent,
+    the last RECENT_SPANS finished spans are kept in `recent`.
+    """
+
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+        self.recent = deque(maxlen=RECENT_SPANS)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def inc(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name, value):
+        with self._lock:
+            if name not in self.histograms:
+                self.histograms[name] = Histogram()
+            self.histograms[name].observe(value)
+
+    @contextmanager
+    def span(self, name):
+        stack = self._local.__dict__.setdefault("stack", [])
+        parent = stack[-1] if stack else None
+        stack.append(name)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - start
+            stack.pop()
+            self.observe(f"{name}_seconds", duration)
+            with self._lock:
+                self.recent.append({"name": name, "parent": parent, "start": time.time() - duration, "seconds": duration})
+
+    def reset(self):
+        with self._lock:
+            self.counters.clear()
+            self.histograms.clear()
+            self.recent.clear()
+
+    def snapshot(self):
+        """
+        returns the current values as plain dicts
+        """
+        with self._lock:
+            return {
+                "counters": dict(self.counters),
+                "histograms": {
+                    name: {
+                        "count": histogram.count,
+                        "sum": histogram.sum,
+                        "buckets": dict(zip(map(str, BUCKETS), histogram.counts)),
+                    }
+                    for name, histogram in self.histograms.items()
+                },
+                "recent": list(self.recent),
+            }
+
+    def to_json(self):
+        return json.dumps(self.snapshot(), indent=1)
+
+    def to_prometheus(self):
+        """
+        returns the counters and histograms in the Prometheus text exposition format
+        """
+        lines = []
+        snapshot = self.snapshot()
+
+        for name, value in sorted(snapshot["counters"].items()):
+            lines += [f"# TYPE {name}_total counter", f"{name}_total {value}"]
+
+        for name, histogram in sorted(snapshot["histograms"].items()):
+            lines.append(f"# TYPE {name} histogram")
+            cumulative = 0
+            for bound, count in histogram["buckets"].items():
+                cumulative += count
+                bound = "+Inf" if bound == "inf" else bound
+                lines.append(f'{name}_bucket{{le="{bound}"}} {cumulative}')
+            lines += [f"{name}_sum {histogram['sum']}", f"{name}_count {histogram['count']}"]
+
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+span = REGISTRY.span
+inc = REGISTRY.inc
+observe = REGISTRY.observe
+
+
+def summary():
+    """
+    returns one {"name", "count", "total", "mean"} dict per span, slowest in total first
+    """
+    rows = [
+        {"name": name[: -len("_seconds")], "count": histogram["count"], "total": histogram["sum"]}
+        for name, histogram in REGISTRY.snapshot()["histograms"].items()
+        if name.endswith("_seconds")
+    ]
+    for row in rows:
+        row["mean"] = row["total"] / row["count"]
+    return sorted(rows, key=lambda row: row["total"], reverse=True)
@@ -0,0 +1,149 @@
+import sys
+from array import array
+
+import numpy as np
+import pandas as pd
+
+RECORD_COLUMNS = [
+    "gene_names",
+    "patientId",
+    "sex",
+    "age",
+    "staining",
+    "intensity",
+    "quantity",
+    "location",
+    "tissueDescriptions",
+    "imageUrl",
+]
+
+
+def _intern(value):
+    return sys.intern(value) if value is not None else None
+
+
+class PatientImages:
+    """
+    Compact form of the records returned by `get_patient_info`.
+
+    Instead of one dict per image, patient fields are stored once per patient and every image
+    only keeps the index of its patient, the index of its (deduplicated) tissue descriptions and its url.
+    Repeated strings are interned, so each distinct value exists once in memory.
+    """
+
+    __slots__ = (
+        "names",
+        "patient_ids",
+        "sexes",
+        "ages",
+        "stainings",
+        "intensities",
+        "quantities",
+        "locations",
+        "descriptions",
+        "description_ids",
+        "image_patients",
+        "image_descriptions",
+        "image_urls",
+    )
+
+    def __init__(self, names):
+        self.names = names
+
+        # patient table
+        self.patient_ids = []
+        self.sexes = []
+        self.ages = array("h")
+        self.stainings = []
+        self.intensities = []
+        self.quantities = []
+        self.locations = []
+
+        # distinct tissue description tuples
+        self.descriptions = []
+        self.description_ids = {}
+
+        # image table
+        self.image_patients = array("i")
+        self.image_descriptions = array("i")
+        self.image_urls = []
+
+    def add_patient(self, patient_id, sex, age, staining, intensity, quantity, location):
+        """
+        returns the index of the new patient
+        """
+        self.patient_ids.append(str(patient_id))
+        self.sexes.append(_intern(sex))
+        self.ages.append(age)
+        self.stainings.append(_intern(staining))
+        self.intensities.append(_intern(intensity))
+        self.quantities.append(_intern(quantity))
+        self.locations.append(_intern(location))
+        return len(self.patient_ids) - 1
+
+    def add_image(self, patient, tissue_descriptions, image_url):
+        key = tuple(tissue_descriptions)
+        description = self.description_ids.get(key)
+        if description is None:
+            description = self.description_ids[key] = len(self.descriptions)
+            self.descriptions.append(tuple(_intern(value) for value in key))
+
+        self.image_patients.append(patient)
+        self.image_descriptions.append(description)
+        self.image_urls.append(image_url)
+
+    def __len__(self):
+        return len(self.image_urls)
+
+    def __iter__(self):
+        """
+        yields the same dicts as `get_patient_info`
+        """
+        for patient, description, image_url in zip(self.image_patients, self.image_descriptions, self.image_urls):
+            yield {
+                "gene_names": self.names,
+                "patientId": self.patient_ids[patient],
+                "sex": self.sexes[patient],
+                "age": self.ages[patient],
+                "staining": self.stainings[patient],
+                "intensity": self.intensities[patient],
+                "quantity": self.quantities[patient],
+                "location": self.locations[patient],
+                "tissueDescriptions": list(self.descriptions[description]),
+                "imageUrl": image_url,
+            }
+
+    def to_records(self):
+        return list(self)
+
+    def to_dataframe(self):
+        """
+        returns the same dataframe as `pd.DataFrame(get_patient_info(...))`, built column by column
+        """
+        patients = np.frombuffer(self.image_patients, dtype=np.int32)
+
+        def patient_column(values):
+            return np.array(values, dtype=object)[patients]
+
+        descriptions = np.empty(len(self.descriptions), dtype=object)
+        for i, values in enumerate(self.descriptions):
+            descriptions[i] = list(values)
+        gene_names = np.empty(len(self), dtype=object)
+        gene_names.fill(self.names)
+
+        return pd.DataFrame(
+            {
+                "gene_names": gene_names,
+                "patientId": patient_column(self.patient_ids),
+                "sex": patient_column(self.sexes),
+                "age": np.frombuffer(self.ages, dtype=np.int16)[patients].astype(np.int64),
+                "staining": patient_column(self.stainings),
+                "intensity": patient_column(self.intensities),
+                "quantity": patient_column(self.quantities),
+                "location": patient_column(self.locations),
+                # rows with the same descriptions share one list
+                "tissueDescriptions": descriptions[np.frombuffer(self.image_descriptions, dtype=np.int32)],
+                "imageUrl": np.array(self.image_urls, dtype=object),
+            },
+            columns=RECORD_COLUMNS,
+        )
@@ -0,0 +1,123 @@
+import os
+import uuid
+import shutil
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+from metrics import inc, span
+
+DATASET_DIR = "./dataset"
+PARTITIONING = ("gene",)
+
+_category = pa.dictionary(pa.int32(), pa.string())
+
+SCHEMA = pa.schema(
+    [
+        ("gene", pa.string()),
+        ("version", pa.string()),
+        ("gene_names", pa.list_(pa.string())),
+        ("patientId", pa.string()),
+        ("sex", _category),
+        ("age", pa.int16()),
+        ("staining", _category),
+        ("intensity", _category),
+        ("quantity", _category),
+        ("location", _category),
+        ("tissueDescriptions", pa.list_(pa.string())),
+        ("imageUrl", pa.string()),
+    ]
+)
+
+
+def records_to_table(records: list, version: str = "latest") -> pa.Table:
+    """
+    Convert records from `process_xml` into an arrow table.
+
+    Low-cardinality columns (sex, staining, intensity, quantity, location) are dictionary encoded,
+    gene names and tissue descriptions become list<string> columns. `gene` is the first gene name.
+    """
+    columns = {"gene": [record["gene_names"][0] for record in records], "version": [version] * len(records)}
+    for field in SCHEMA:
+        if field.name in columns:
+            continue
+        values = [record[field.name] for record in records]
+        if field.type == _category:
+            columns[field.name] = pa.array(values, type=pa.string()).dictionary_encode()
+        else:
+            columns[field.name] = pa.array(values, type=field.type)
+
+    return pa.table(columns, schema=SCHEMA)
+
+
+def _partitioning(partitioning):
+    return ds.partitioning(pa.schema([SCHEMA.field(name) for name in partitioning]), flavor="hive")
+
+
+@span("write_records")
+def write_records(
+    records: list,
+    dataset_dir: str = DATASET_DIR,
+    version: str = "latest",
+    partitioning: tuple = PARTITIONING,
+    append: bool = False,
+) -> None:
+    """
+    Append records to the parquet dataset in `dataset_dir`, partitioned by `partitioning`
+    (e.g. ("gene",) or ("version", "gene")). Partitions that are written replace what was there before,
+    unless `append` is set: then the records are added to them in new files.
+    """
+    if not records:
+        return
+
+    inc("records_written", len(records))
+    os.makedirs(dataset_dir, exist_ok=True)
+    ds.write_dataset(
+        records_to_table(records, version),
+        dataset_dir,
+        format="parquet",
+        partitioning=_partitioning(partitioning),
+        existing_data_behavior="overwrite_or_ignore" if append else "delete_matching",
+        basename_template=f"part-{uuid.uuid4().hex}-{{i}}.parquet" if append else "part-{i}.parquet",
+    )
+
+
+def delete_records(
+    genes: list, dataset_dir: str = DATASET_DIR, version: str = "latest", partitioning: tuple = PARTITIONING
+) -> None:
+    """
+    Remove the partitions of `genes` (of `version`, when it's part of the partitioning) from the dataset.
+    """
+    for gene in genes:
+        values = {"gene": gene, "version": version}
+        expression = None
+        for name in partitioning:
+            condition = pc.field(name) == values[name]
+            expression = condition if expression is None else expression & condition
+
+        directory, _ = _partitioning(partitioning).format(expression)
+        path = os.path.join(dataset_dir, directory)
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+
+
+def read_records(
+    dataset_dir: str = DATASET_DIR, genes: list = None, filter=None, columns: list = None, partitioning: tuple = PARTITIONING
+) -> pd.DataFrame:
+    """
+    Load records from the parquet dataset. `genes` and `filter` (a pyarrow.compute expression)
+    are pushed down, so only matching partitions and row groups are read.
+    """
+    dataset = ds.dataset(dataset_dir, format="parquet", partitioning=_partitioning(partitioning))
+
+    if genes is not None:
+        gene_filter = pc.field("gene").isin(genes)
+        filter = gene_filter if filter is None else filter & gene_filter
+
+    return dataset.to_table(columns=columns, filter=filter).to_pandas()
+
+
+if __name__ == "__main__":
+    df = read_records(genes=["EGFR"], filter=pc.field("sex") == "Female")
+    print(df.head())
@@ -0,0 +1,180 @@
+import os
+import sys
+import time
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL import Image
+from metrics import inc, span
+from xml_loader import CACHE_DIR
+from image_manifest import IMAGE_MANIFEST, ImageManifest
+
+THUMBNAIL_DIR = os.path.join(CACHE_DIR, "thumbnails")
+THUMBNAIL_SIZE = 256  # longest side in pixels, what the dashboard's image grid shows
+TILE_SIZE = 512  # full resolution tiles, for zooming into an image
+JPEG_QUALITY = 80
+THUMBNAIL = "thumbnail"
+# Images Pillow can't read: truncated or not images at all, or too big to be decoded safely
+IMAGE_ERRORS = (OSError, ValueError, SyntaxError, Image.DecompressionBombError)
+
+
+def derivative_path(cache_dir: str, sha256: str, kind: str) -> str:
+    # Named after the content of the source image, an image reachable from several urls is processed once
+    return os.path.join(cache_dir, sha256[:2], f"{sha256}_{kind}.jpg")
+
+
+def _save(image, path):
+    # Write to a temporary file first, a file under its final name is always complete
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with tempfile.NamedTemporaryFile(dir=os.path.dirname(path), suffix=".tmp", delete=False) as file:
+        image.save(file, "JPEG", quality=JPEG_QUALITY, optimize=True)
+    os.replace(file.name, path)
+
+
+def tile_prefix(tile_size: int) -> str:
+    # Tiles of different sizes are different derivatives
+    return f"tile{tile_size}_"
+
+
+def make_derivatives(
+    source: str, sha256: str, cache_dir: str = THUMBNAIL_DIR, thumbnail_size: int = THUMBNAIL_SIZE, tile_size: int = None
+):
+    """
+    Create the thumbnail of `source` (unless `thumbnail_size` is None) and, if `tile_size` is given,
+    its tiles of `tile_size` × `tile_size` pixels.
+
+    returns (sha256, {kind: path}, error message or None), kinds are "thumbnail" and "tile<size>_<row>_<column>"
+    """
+    try:
+        return sha256, _make_derivatives(source, sha256, cache_dir, thumbnail_size, tile_size), None
+    except IMAGE_ERRORS as e:
+        return sha256, {}, f"{type(e).__name__}: {e}"
+
+
+def _make_derivatives(source, sha256, cache_dir, thumbnail_size, tile_size):
+    derivatives = {}
+    with Image.open(source) as image:
+        if tile_size:
+            image.load()
+            for top in range(0, image.height, tile_size):
+                for left in range(0, image.width, tile_size):
+                    kind = f"{tile_prefix(tile_size)}{top // tile_size}_{left // tile_size}"
+                    derivatives[kind] = derivative_path(cache_dir, sha256, kind)
+                    _save(image.crop((left, top, left + tile_size, top + tile_size)).convert("RGB"), derivatives[kind])
+
+        if thumbnail_size:
+            # JPEGs are decoded straight at a reduced scale, much faster than decoding the full image and shrinking it
+            image.draft("RGB", (thumbnail_size, thumbnail_size))
+            image.thumbnail((thumbnail_size, thumbnail_size))
+            derivatives[THUMBNAIL] = derivative_path(cache_dir, sha256, THUMBNAIL)
+            _save(image.convert("RGB"), derivatives[THUMBNAIL])
+
+    return derivatives
+
+
+def _connect(manifest):
+    image_manifest = ImageManifest(manifest)
+    image_manifest.db.execute(
+        """
+        CREATE TABLE IF NOT EXISTS derivatives (
+            sha256 TEXT NOT NULL,
+            kind TEXT NOT NULL,
+            path TEXT NOT NULL,
+            PRIMARY KEY (sha256, kind)
+        )
+        """
+    )
+    image_manifest.db.execute(
+        """
+        CREATE TABLE IF NOT EXISTS derivative_errors (
+            sha256 TEXT PRIMARY KEY,
+            error TEXT NOT NULL,
+            updated_at REAL NOT NULL
+        )
+        """
+    )
+    return image_manifest
+
+
+@span("generate_thumbnails")
+def generate_thumbnails(
+    image_urls=None,
+    manifest=IMAGE_MANIFEST,
+    cache_dir=THUMBNAIL_DIR,
+    thumbnail_size=THUMBNAIL_SIZE,
+    tile_size=None,
+    max_workers=None,
+):
+    """
+    Create the thumbnails (and tiles) of the downloaded images of `image_urls` (all of them if None), meant to run
+    after `download_images`. Images are decoded and resized in a process pool, one process per CPU by default.
+
+    Derivatives are cached by the sha256 of the image and recorded in the `derivatives` table of the manifest,
+    where the dashboard finds them. Each kind is skipped on its own: an image with a thumbnail still gets
+    its tiles when `tile_size` is asked for the first time, and the other way round.
+    Images that can't be decoded are recorded in `derivative_errors` and skipped, here and in later runs.
+
+    returns {url: thumbnail path}
+    """
+    with _connect(manifest) as image_manifest:
+        images = image_manifest.lookup(image_urls if image_urls is not None else image_manifest.urls())
+        done = {
+            sha256: path
+            for sha256, path in image_manifest.db.execute("SELECT sha256, path FROM derivatives WHERE kind = ?", (THUMBNAIL,))
+        }
+        done = {sha256: path for sha256, path in done.items() if os.path.exists(path)}
+        tiled = set()
+        if tile_size:
+            tiled = {
+                sha256
+                for (sha256,) in image_manifest.db.execute(
+                    "SELECT DISTINCT sha256 FROM derivatives WHERE kind LIKE ?", (f"{tile_prefix(tile_size)}%",)
+                )
+            }
+
+        failed = {sha256 for (sha256,) in image_manifest.db.execute("SELECT sha256 FROM derivative_errors")}
+
+        # {sha256: (source, thumbnail size or None, tile size or None)}
+        todo = {}
+        for image in images.values():
+            sha256 = image["sha256"]
+            if sha256 in failed:
+                inc("thumbnails_skipped")
+                continue
+            thumbnail = None if sha256 in done else thumbnail_size
+            tiles = tile_size if tile_size and sha256 not in tiled else None
+            if thumbnail or tiles:
+                todo[sha256] = (image["path"], thumbnail, tiles)
+            else:
+                inc("thumbnails_cached")
+
+        if todo:
+            sources, thumbnail_sizes, tile_sizes = zip(*todo.values())
+            with ProcessPoolExecutor(max_workers) as executor:
+                results = executor.map(
+                    make_derivatives, sources, todo.keys(), [cache_dir] * len(todo), thumbnail_sizes, tile_sizes, chunksize=16
+                )
+                for sha256, derivatives, error in results:
+                    if error is not None:
+                        # One broken image doesn't stop the others
+                        inc("thumbnails_failed")
+                        with image_manifest.db:
+                            image_manifest.db.execute(
+                                "INSERT OR REPLACE INTO derivative_errors VALUES (?, ?, ?)", (sha256, error, time.time())
+                            )
+                        continue
+                    with image_manifest.db:
+                        image_manifest.db.executemany(
+                            "INSERT OR REPLACE INTO derivatives VALUES (?, ?, ?)",
+                            ((sha256, kind, os.path.abspath(path)) for kind, path in derivatives.items()),
+                        )
+                    if THUMBNAIL in derivatives:
+                        done[sha256] = os.path.abspath(derivatives[THUMBNAIL])
+                    inc("thumbnails_created")
+    return {url: done[image["sha256"]] for url, image in images.items() if image["sha256"] in done}
+
+
+if __name__ == "__main__":
+    # Thumbnails of every image in the manifest
+    thumbnails = generate_thumbnails(tile_size=TILE_SIZE if "--tiles" in sys.argv[1:] else None)
+    print(f"{len(thumbnails)} thumbnails in {THUMBNAIL_DIR}")
@@ -0,0 +1,173 @@
+import os
+import gzip
+import time
+import hashlib
+import sqlite3
+import tempfile
+from contextlib import closing
+
+import requests
+from metrics import inc, span
+from xml_loader import CACHE_DIR, version_to_xml_url
+
+XML_CACHE_DIR = os.path.join(CACHE_DIR, "xml")
+XML_CACHE_BUDGET = 2 * 2**30  # bytes of compressed "latest" XMLs kept before the least recently used are evicted
+
+
+def _connect(cache_dir):
+    os.makedirs(os.path.join(cache_dir, "objects"), exist_ok=True)
+    db = sqlite3.connect(os.path.join(cache_dir, "index.sqlite"), timeout=60)
+    db.execute(
+        """
+        CREATE TABLE IF NOT EXISTS entries (
+            ensembl_id TEXT NOT NULL,
+            version TEXT NOT NULL,
+            digest TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            etag TEXT,
+            last_modified TEXT,
+            checked_at REAL NOT NULL,
+            accessed_at REAL NOT NULL,
+            PRIMARY KEY (ensembl_id, version)
+        )
+        """
+    )
+    return db
+
+
+def object_path(cache_dir: str, digest: str) -> str:
+    return os.path.join(cache_dir, "objects", digest[:2], f"{digest}.xml.gz")
+
+
+def object_digest(path: str) -> str:
+    # The sha256 of the uncompressed XML, objects are named after it
+    return os.path.basename(path).split(".")[0]
+
+
+def _store_object(cache_dir, content):
+    # Objects are named after the sha256 of the uncompressed XML, identical files across versions are stored once
+    digest = hashlib.sha256(content).hexdigest()
+    path = object_path(cache_dir, digest)
+    if os.path.exists(path):
+        return digest, path
+
+    # Write to a temporary file first, a file under its final name is always complete
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with tempfile.NamedTemporaryFile(dir=os.path.dirname(path), suffix=".tmp", delete=False) as file:
+        with gzip.GzipFile(fileobj=file, mode="wb", mtime=0) as compressed:
+            compressed.write(content)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(file.name, path)
+
+    return digest, path
+
+
+def evict(cache_dir: str = XML_CACHE_DIR, budget: int = XML_CACHE_BUDGET, keep: tuple = None, in_use=()) -> None:
+    """
+    Drop least recently used "latest" entries until the cache fits in `budget` bytes.
+    Pinned versions, the `keep` (ensembl_id, version) entry and the entries of `in_use` are never evicted.
+    """
+    with closing(_connect(cache_dir)) as db, db:
+        used = db.execute("SELECT COALESCE(SUM(size), 0) FROM (SELECT DISTINCT digest, size FROM entries)").fetchone()[0]
+        candidates = db.execute(
+            "SELECT ensembl_id, version, digest, size FROM entries WHERE version = 'latest' ORDER BY accessed_at"
+        ).fetchall()
+
+        for ensembl_id, version, digest, size in candidates:
+            if used <= budget:
+                break
+            if (ensembl_id, version) == keep or (ensembl_id, version) in in_use:
+                continue
+            db.execute("DELETE FROM entries WHERE ensembl_id = ? AND version = ?", (ensembl_id, version))
+            if _remove_unreferenced(db, cache_dir, digest):
+                used -= size
+
+
+def _remove_unreferenced(db, cache_dir, digest):
+    # The object may still be referenced by a pinned version or another gene, returns whether it was removed
+    if db.execute("SELECT 1 FROM entries WHERE digest = ?", (digest,)).fetchone() is not None:
+        return False
+    if os.path.exists(object_path(cache_dir, digest)):
+        os.remove(object_path(cache_dir, digest))
+    return True
+
+
+@span("fetch_xml")
+def fetch_xml(
+    ensembl_id: str,
+    version: str = "latest",
+    cache_dir: str = XML_CACHE_DIR,
+    max_age: float = 0,
+    budget: int = XML_CACHE_BUDGET,
+    session: requests.Session = None,
+    in_use=(),
+) -> str:
+    """
+    returns the path of the gzip compressed XML of `ensembl_id`, downloading it only when needed
+
+    Pinned versions (anything but "latest") never change and are served from the cache forever.
+    "latest" is revalidated with If-None-Match / If-Modified-Since once it's older than `max_age` seconds.
+    Making room for the new file never evicts the (ensembl_id, version) entries of `in_use`, e.g. files still to be parsed.
+    """
+    now = time.time()
+
+    with closing(_connect(cache_dir)) as db, db:
+        row = db.execute(
+            "SELECT digest, etag, last_modified, checked_at FROM entries WHERE ensembl_id = ? AND version = ?",
+            (ensembl_id, version),
+        ).fetchone()
+
+    headers = {}
+    if row is not None and os.path.exists(object_path(cache_dir, row[0])):
+        digest, etag, last_modified, checked_at = row
+        if version != "latest" or now - checked_at < max_age:
+            with closing(_connect(cache_dir)) as db, db:
+                db.execute("UPDATE entries SET accessed_at = ? WHERE ensembl_id = ? AND version = ?", (now, ensembl_id, version))
+            inc("xml_cache_hits")
+            return object_path(cache_dir, digest)
+
+        if etag:
+            headers["If-None-Match"] = etag
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified
+
+    response = (session or requests).get(version_to_xml_url(ensembl_id, version), headers=headers)
+    if response.status_code == 304:
+        inc("xml_cache_revalidated")
+        with closing(_connect(cache_dir)) as db, db:
+            db.execute(
+                "UPDATE entries SET checked_at = ?, accessed_at = ? WHERE ensembl_id = ? AND version = ?",
+                (now, now, ensembl_id, version),
+            )
+        return object_path(cache_dir, row[0])
+    response.raise_for_status()
+    inc("xml_cache_misses")
+    inc("xml_bytes", len(response.content))
+
+    digest, path = _store_object(cache_dir, response.content)
+    with closing(_connect(cache_dir)) as db, db:
+        db.execute(
+            "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                ensembl_id,
+                version,
+                digest,
+                os.path.getsize(path),
+                response.headers.get("ETag"),
+                response.headers.get("Last-Modified"),
+                now,
+                now,
+            ),
+        )
+        # The previous content of a changed "latest" entry is not referenced anymore
+        if row is not None and row[0] != digest:
+            _remove_unreferenced(db, cache_dir, row[0])
+
+    evict(cache_dir, budget, keep=(ensembl_id, version), in_use=in_use)
+    return path
+
+
+if __name__ == "__main__":
+    path = fetch_xml("ENSG00000146648")
+    print(path)
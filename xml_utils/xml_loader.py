@@ -1,46 +1,114 @@
 import os
+import json
+import time
 from io import StringIO
 
 import requests
 import pandas as pd
+from metrics import inc, span
 
+LOOKUP_URL = "https://www.proteinatlas.org/search?format=tsv"
+CACHE_DIR = "./cache"
+LOOKUP_TTL = 24 * 60 * 60  # seconds before the cached lookup table is revalidated
 
-def download_lookup_df():
-    # Download the data
-    response = requests.get("https://www.proteinatlas.org/search?format=tsv")
+
+def _fetch_lookup_df(etag=None):
+    # Download the data, unless it hasn't changed since the cached copy
+    headers = {"If-None-Match": etag} if etag else {}
+    response = requests.get(LOOKUP_URL, headers=headers)
+    if response.status_code == 304:
+        return None, etag
     response.raise_for_status()
 
-    # Convert the downloaded data to a DataFrame
+    # Convert the downloaded data to a DataFrame, only 'Gene' and 'Ensembl' columns are needed
     data = StringIO(response.text)
-    query_df = pd.read_csv(data, sep="\t")
-
-    # Create a subset with only 'Gene' and 'Ensembl' columns
+    query_df = pd.read_csv(data, sep="\t", usecols=["Gene", "Ensembl"])
     lookup_df = query_df[["Gene", "Ensembl"]].rename(columns={"Gene": "gene", "Ensembl": "ensembl"})
 
+    return lookup_df, response.headers.get("ETag")
+
+
+def download_lookup_df(cache_dir: str = CACHE_DIR, ttl: float = LOOKUP_TTL) -> pd.DataFrame:
+    """
+    returns the gene/ensembl lookup dataframe
+
+    The table is kept as a parquet snapshot in `cache_dir`. Within `ttl` seconds of the last check
+    it is read from disk only, after that it is revalidated with the stored ETag.
+    A stale snapshot is used when proteinatlas.org can't be reached.
+    """
+    table_path = os.path.join(cache_dir, "lookup.parquet")
+    meta_path = os.path.join(cache_dir, "lookup.json")
+
+    cached = os.path.exists(table_path) and os.path.exists(meta_path)
+    meta = {}
+    if cached:
+        with open(meta_path) as file:
+            meta = json.load(file)
+        if time.time() - meta["checked_at"] < ttl:
+            return pd.read_parquet(table_path)
+
+    try:
+        lookup_df, etag = _fetch_lookup_df(meta.get("etag"))
+    except requests.RequestException:
+        if cached:
+            return pd.read_parquet(table_path)
+        raise
+
+    os.makedirs(cache_dir, exist_ok=True)
+    if lookup_df is None:
+        lookup_df = pd.read_parquet(table_path)
+    else:
+        lookup_df.to_parquet(f"{table_path}.tmp", index=False)
+        os.replace(f"{table_path}.tmp", table_path)
+
+    with open(f"{meta_path}.tmp", "w") as file:
+        json.dump({"etag": etag, "checked_at": time.time()}, file)
+    os.replace(f"{meta_path}.tmp", meta_path)
+
     return lookup_df
 
 
+def build_gene_index(lookup_df: pd.DataFrame) -> dict:
+    """
+    returns {gene: ensembl id}, keeping the first id of genes listed more than once
+    """
+    return dict(zip(lookup_df["gene"].iloc[::-1], lookup_df["ensembl"].iloc[::-1]))
+
+
 def version_to_xml_url(ensembl_id: str, version: str = "latest") -> str:
     version = "www" if version == "latest" else version
     return f"https://{version}.proteinatlas.org/{ensembl_id}.xml"
 
 
+def version_to_dump_url(version: str = "latest") -> str:
+    # Every entry of the release in a single compressed XML
+    version = "www" if version == "latest" else version
+    return f"https://{version}.proteinatlas.org/download/proteinatlas.xml.gz"
+
+
 def version_to_interactions_url(ensembl_id: str, gene: str, version: str = "latest") -> str:
     version = "www" if version == "latest" else version
     return f"https://{version}.proteinatlas.org/{ensembl_id}-{gene}/interaction"
 
 
-def get_gene_xml_url(gene: str, lookup_df: pd.DataFrame, version: str = "latest"):
+def get_gene_xml_url(gene: str, lookup: dict | pd.DataFrame, version: str = "latest"):
     """
     returns links to xml and interactions
+
+    `lookup` is either the index from `build_gene_index` or the lookup dataframe itself (slower)
     """
-    ensembl_id = lookup_df.loc[lookup_df["gene"] == gene, "ensembl"].iat[0]
+    if isinstance(lookup, pd.DataFrame):
+        ensembl_id = lookup.loc[lookup["gene"] == gene, "ensembl"].iat[0]
+    else:
+        ensembl_id = lookup[gene]
     return version_to_xml_url(ensembl_id, version), version_to_interactions_url(ensembl_id, gene, version)
 
 
+@span("download_xml")
 def download_xml(url: str, gene: str, version: str = "latest") -> None:
     response = requests.get(url)
     response.raise_for_status()
+    inc("xml_bytes", len(response.content))
 
     folder_name = "./xml_files"
     os.makedirs(folder_name, exist_ok=True)
@@ -1,10 +1,86 @@
+import os
+import re
+import gzip
+import codecs
 import xml.etree.ElementTree as ET
 
 import pandas as pd
+from metrics import inc, span
+from patient_images import RECORD_COLUMNS, PatientImages
 
+# Characters XML 1.0 doesn't allow, and "&" that doesn't start one of the predefined entities or a character reference
+INVALID_XML_CHARS = re.compile("[\x00-\x08\x0b\x0c\x0e-\x1f\ufffe\uffff]")
+BARE_AMPERSAND = re.compile(r"&(?!(?:amp|lt|gt|quot|apos|#[0-9]+|#x[0-9a-fA-F]+);)")
+MAX_REFERENCE = 16  # longer than any reference BARE_AMPERSAND accepts
 
-def load_xml(filename):
-    tree = ET.parse(filename)
+# What a <patient> with missing or malformed fields raises
+PATIENT_ERRORS = (AttributeError, ValueError, KeyError, TypeError)
+
+
+class SanitizingReader:
+    """
+    Binary file wrapper that repairs UTF-8 XML on the fly: invalid bytes become U+FFFD, characters XML doesn't allow
+    are dropped and bare "&" are escaped. `repairs` counts the changes.
+    """
+
+    def __init__(self, raw, close_raw=True):
+        self.raw = raw
+        self.close_raw = close_raw
+        self.decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        self.pending = ""  # a possibly incomplete reference at the end of the last chunk
+        self.done = False
+        self.repairs = 0
+
+    def read(self, size=-1):
+        # An empty result means EOF to the parser, a chunk that was only invalid characters must not end the file
+        text = ""
+        while not text and not self.done:
+            chunk = self.raw.read(size)
+            text = self.pending + self.decoder.decode(chunk, final=not chunk)
+            self.pending = ""
+            self.done = not chunk
+
+            # hold back an "&" that may be completed by the next chunk
+            cut = text.rfind("&")
+            if not self.done and cut != -1 and ";" not in text[cut:] and len(text) - cut < MAX_REFERENCE:
+                text, self.pending = text[:cut], text[cut:]
+
+            text, invalid = INVALID_XML_CHARS.subn("", text)
+            text, ampersands = BARE_AMPERSAND.subn("&amp;", text)
+            self.repairs += invalid + ampersands + text.count("\ufffd")
+        return text.encode("utf-8")
+
+    def close(self):
+        if self.close_raw:
+            self.raw.close()
+
+
+def open_xml(source, recover=False):
+    """
+    Compressed files (e.g. from the XML cache) are decompressed on the fly.
+    With `recover`, the bytes go through a `SanitizingReader`.
+    """
+    is_path = isinstance(source, (str, os.PathLike))
+    if is_path and os.fspath(source).endswith(".gz"):
+        raw = gzip.open(source, "rb")
+    elif is_path and recover:
+        raw = open(source, "rb")
+    else:
+        raw = source
+
+    if recover:
+        return SanitizingReader(raw, close_raw=raw is not source)
+    return raw
+
+
+@span("load_xml")
+def load_xml(filename, recover=False):
+    source = open_xml(filename, recover)
+    try:
+        tree = ET.parse(source)
+    finally:
+        if source is not filename:
+            source.close()
     root = tree.getroot()
     return root
 
@@ -17,94 +93,279 @@ def get_synonyms(entry):
     return [syn.text for syn in entry.findall("synonym")]
 
 
-def get_patient_info(root, names):
-    # FIXME there appears to be an invalid symbol in some XMLs that causes an error
+def get_patient_fields(patient):
+    """
+    returns (patientId, sex, age, staining, intensity, quantity, location) of a <patient> element
+    """
+    # Plain tag lookups run in C, only the level[@type=...] predicates went through the python ElementPath engine,
+    # so levels are told apart in a single pass instead
+    fields = {field: patient.find(field) for field in ("patientId", "sex", "age")}
+    missing = [field for field, elem in fields.items() if elem is None]
+    if missing:
+        raise ValueError(f"patient without {', '.join(missing)}")
+
+    # Extract basic patient info
+    patient_id = int(fields["patientId"].text)
+    sex = fields["sex"].text
+    age = int(fields["age"].text)
+
+    staining = intensity = None
+    staining_found = intensity_found = False
+    for level in patient.findall("level"):
+        level_type = level.get("type")
+        if level_type == "staining" and not staining_found:
+            staining, staining_found = level.text, True
+        elif level_type == "intensity" and not intensity_found:
+            intensity, intensity_found = level.text, True
+
+    quantity = patient.find("quantity")
+    quantity = quantity.text if quantity is not None else None
+
+    location = patient.find("location")
+    location = location.text if location is not None else None
+
+    return str(patient_id), sex, age, staining, intensity, quantity, location
+
+
+def get_patient_samples(patient):
+    """
+    returns (tissue descriptions, image url) for every image of a <patient> element
+
+    The subtree is walked once, dispatching on the tag, instead of a `.//sample` search plus lookups per sample.
+    This relies on the HPA layout: sample > snomedParameters > snomed and sample > assayImage > image > imageUrl.
+    """
+    samples = []
+    tissue_descriptions = None
+    for element in patient.iter():
+        tag = element.tag
+        if tag == "sample":
+            # shared by the images of the sample
+            tissue_descriptions = []
+        elif tag == "snomed":
+            tissue_descriptions.append(element.attrib["tissueDescription"])
+        elif tag == "imageUrl":
+            samples.append((tissue_descriptions, element.text))
+    return samples
+
+
+def get_patient_images(patient, names):
+    """
+    returns one record per image of a single <patient> element
+    """
+    patient_id, sex, age, staining, intensity, quantity, location = get_patient_fields(patient)
+
+    return [
+        {
+            "gene_names": names,  # This is a list of gene synonyms
+            "patientId": patient_id,
+            "sex": sex,
+            "age": age,
+            "staining": staining,
+            "intensity": intensity,
+            "quantity": quantity,
+            "location": location,
+            "tissueDescriptions": tissue_descriptions,
+            "imageUrl": image_url,
+        }
+        for tissue_descriptions, image_url in get_patient_samples(patient)
+    ]
+
+
+def _skip_patient(patient, names, error, errors):
+    inc("patients_skipped")
+    errors.append(
+        {
+            "gene": names[0] if names else None,
+            "patientId": patient.findtext("patientId"),
+            "error": f"{type(error).__name__}: {error}",
+        }
+    )
+
+
+def read_patient_images(patient, names, errors=None):
+    """
+    `get_patient_images`, but when `errors` is a list, a patient that can't be read (e.g. without patientId or age)
+    is reported there and skipped instead of raising
+    """
+    if errors is None:
+        return get_patient_images(patient, names)
+    try:
+        return get_patient_images(patient, names)
+    except PATIENT_ERRORS as e:
+        _skip_patient(patient, names, e, errors)
+        return []
 
-    # Create an empty list to store patient info for each image
-    patient_images_info = []
+
+def add_patient_images(patient_images, patient, errors=None):
+    """
+    adds a single <patient> element to a `PatientImages`, see `read_patient_images` for `errors`
+    """
+    try:
+        fields = get_patient_fields(patient)
+        samples = get_patient_samples(patient)
+    except PATIENT_ERRORS as e:
+        if errors is None:
+            raise
+        _skip_patient(patient, patient_images.names, e, errors)
+        return
+
+    index = patient_images.add_patient(*fields)
+    for tissue_descriptions, image_url in samples:
+        patient_images.add_image(index, tissue_descriptions, image_url)
+
+
+@span("get_patient_info")
+def get_patient_info(root, names, compact=False, errors=None):
+    # Some XMLs contain invalid symbols, `load_xml(filename, recover=True)` repairs them
+    # and with an `errors` list, patients that can't be read are reported there and skipped
+
+    # Create an empty list to store patient info for each image, or a PatientImages table when compact
+    patient_images_info = PatientImages(names) if compact else []
 
     # Iterate through each tissueCell element in the XML
-    for tissue_cell in root.findall(".//tissueExpression"):
+    for tissue_cell in root.iter("tissueExpression"):
         summary = tissue_cell.find("summary")
 
         # if type is not 'pathology', skip this tissueCell
         if summary.attrib["type"] != "pathology":
             continue
         # Iterate through each patient element inside the current tissueCell
-        for patient in tissue_cell.findall(".//patient"):
-            # Extract basic patient info
-            patient_id = int(patient.find("patientId").text)
-            sex = patient.find("sex").text
-            age = int(patient.find("age").text)
-
-            staining_element = patient.find("level[@type='staining']")
-            staining = staining_element.text if staining_element is not None else None
-
-            intensity = patient.find("level[@type='intensity']")
-            intensity = intensity.text if intensity is not None else None
-
-            quantity = patient.find("quantity")
-            quantity = quantity.text if quantity is not None else None
-
-            location = patient.find("location")
-            location = location.text if location is not None else None
-
-            # Extract SNOMED descriptions and images
-            for sample in patient.findall(".//sample"):
-                snomed_parameters = sample.find("snomedParameters")
-                tissue_descriptions = [snomed.attrib["tissueDescription"] for snomed in snomed_parameters.findall("snomed")]
-
-                assay_image = sample.find("assayImage")
-                for image in assay_image.findall("image"):
-                    image_url = image.find("imageUrl").text
-                    patient_images_info.append(
-                        {
-                            "gene_names": names,  # This is a list of gene synonyms
-                            "patientId": str(patient_id),
-                            "sex": sex,
-                            "age": age,
-                            "staining": staining,
-                            "intensity": intensity,
-                            "quantity": quantity,
-                            "location": location,
-                            "tissueDescriptions": tissue_descriptions,
-                            "imageUrl": image_url,
-                        }
-                    )
+        for patient in tissue_cell.iter("patient"):
+            if compact:
+                add_patient_images(patient_images_info, patient, errors)
+            else:
+                patient_images_info.extend(read_patient_images(patient, names, errors))
+
+    inc("image_rows", len(patient_images_info))
     return patient_images_info
 
 
-def process_xml(xml):
+def process_xml(xml, compact=False, errors=None):
+    """
+    returns one record per image, or a `PatientImages` with the same rows when `compact`
+
+    when `errors` is a list, patients that can't be read are reported there and skipped
+    """
     synonyms = []
     for entry in xml.findall("entry"):
         name = get_name(entry)
         synonyms = get_synonyms(entry)
 
     names = [name] + synonyms
-    info = get_patient_info(xml, names)
+    info = get_patient_info(xml, names, compact, errors)
 
     return info
 
 
+def iter_patient_info(source, errors=None):
+    """
+    Streaming counterpart of `process_xml(load_xml(source))`.
+
+    Yields the same records one image at a time using `iterparse`, dropping every element
+    as soon as it is no longer needed, so memory stays flat regardless of the file size.
+    `source` can be a filename (plain or .gz) or a binary file object.
+    Gene names are taken from the <entry> the patient belongs to.
+
+    When `errors` is a list, parsing recovers instead of raising: the bytes are sanitized (see `SanitizingReader`),
+    patients that can't be read are skipped, and a file that is still broken ends the stream
+    after the records read so far. Each problem is appended to `errors` as a {"gene", "patientId", "error"} dict,
+    the one that ended the stream early also has "fatal": True.
+    """
+    xml_file = open_xml(source, recover=errors is not None)
+    try:
+        yield from _iter_patient_info(xml_file, errors)
+    finally:
+        if xml_file is not source:
+            xml_file.close()
+
+
+def _iter_patient_info(source, errors=None):
+    try:
+        yield from _iter_patient_elements(source, errors)
+    except ET.ParseError as e:
+        if errors is None:
+            raise
+        errors.append({"gene": None, "patientId": None, "error": f"ParseError: {e}", "fatal": True})
+
+    repairs = getattr(source, "repairs", 0)
+    if errors is not None and repairs:
+        errors.append({"gene": None, "patientId": None, "error": f"repaired {repairs} invalid characters"})
+
+
+def _iter_patient_elements(source, errors):
+    stack = []  # currently open elements, root first
+    pathology = []  # one flag per open tissueExpression, None until its summary has been seen
+    pending = []  # patients of a tissueExpression whose summary type is not known yet
+    open_patients = 0
+
+    name, synonyms, names = None, [], None
+
+    for event, elem in ET.iterparse(source, events=("start", "end")):
+        tag = elem.tag
+
+        if event == "start":
+            stack.append(elem)
+            if tag == "entry":
+                name, synonyms, names = None, [], None
+            elif tag == "tissueExpression":
+                pathology.append(None)
+            elif tag == "patient":
+                open_patients += 1
+            continue
+
+        stack.pop()
+        parent = stack[-1] if stack else None
+        parent_tag = parent.tag if parent is not None else None
+
+        if tag == "patient":
+            open_patients -= 1
+        elif open_patients:
+            # part of a patient that is still being read
+            continue
+
+        keep = False
+        if parent_tag == "entry" and tag == "name" and name is None:
+            name = elem.text
+        elif parent_tag == "entry" and tag == "synonym":
+            synonyms.append(elem.text)
+        elif parent_tag == "tissueExpression" and tag == "summary" and pathology[-1] is None:
+            pathology[-1] = elem.attrib["type"] == "pathology"
+            if pathology[-1]:
+                names = names or [name] + synonyms
+                for patient in pending:
+                    yield from read_patient_images(patient, names, errors)
+            pending = []
+        elif tag == "patient" and pathology:
+            if pathology[-1] is None:
+                pending.append(elem)
+                keep = True
+            elif pathology[-1]:
+                names = names or [name] + synonyms
+                yield from read_patient_images(elem, names, errors)
+        elif tag == "tissueExpression":
+            pathology.pop()
+            pending = []
+
+        # drop the finished element so the tree never grows
+        if not keep:
+            elem.clear()
+        if parent is not None:
+            parent.remove(elem)
+
+
+@span("process_xml_stream")
+def process_xml_stream(source, errors=None):
+    records = list(iter_patient_info(source, errors))
+    inc("image_rows", len(records))
+    return records
+
+
 if __name__ == "__main__":
     filename = "xml_files/ANGPTL8_latest.xml"
     xml = load_xml(filename)
     info = process_xml(xml)
     if len(info) == 0:
-        info_df = pd.DataFrame(
-            columns=[
-                "gene_names",
-                "patientId",
-                "sex",
-                "age",
-                "staining",
-                "intensity",
-                "quantity",
-                "location",
-                "tissueDescriptions",
-                "imageUrl",
-            ]
-        )
+        info_df = pd.DataFrame(columns=RECORD_COLUMNS)
     else:
         info_df = pd.DataFrame(info)
     print(info_df.head())